@@ -2,21 +2,25 @@
 manage cached data
 """
 
+from collections import OrderedDict
 from datetime import date
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from rich.progress import track
-
-# fmt: off
-from sqlalchemy import (BigInteger, Column, Engine, Integer, MetaData, Table,
-                        create_engine, inspect, select)
-# fmt: on
-
-from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import create_engine
 
+from dtse import config as cfg
+from dtse.exporter import PriceExporter
 from dtse.logger import logger as tse_logger
-from dtse.tse_utils import to_jalali_date
+from dtse.parallel import adjust_prices_parallel, write_files_parallel
+from dtse.price_adjuster import adjust_prices
+from dtse.storage import ParquetStorage, SQLiteStorage, StorageBackend
+from dtse.trading_calendar import TradingCalendar
+from dtse.tse_utils import to_jalali_dates
+
+# price columns needed to adjust prices and drop days without trades
+REQUIRED_PRICE_COLS = ["PClosing", "PriceYesterday", "ZTotTran", "QTotTran5J"]
 
 
 class TSECache:
@@ -33,20 +37,66 @@ class TSECache:
 
         self.settings = settings
         self._instruments: pd.DataFrame | None = None
+        # instruments the symbol index was built from and the index
+        self._symbol_index: tuple[pd.DataFrame, dict] | None = None
         self._splits: pd.DataFrame | None = None
         self._prices: pd.DataFrame | None = None
+        # downloaded blocks not yet merged into _prices
+        self._prices_blocks: list[pd.DataFrame] = []
         self._prices_merged: pd.DataFrame | None = None
+        # price frame and the content hash of each of its codes
+        self._prices_hash: tuple[pd.DataFrame, pd.Series] | None = None
+        # adjusted prices by (codes, adjust type): (version, data)
+        self._adjusted: OrderedDict[tuple, tuple[str, pd.DataFrame]] = OrderedDict()
         self._last_devens: pd.DataFrame | None = None
-        self._engine: Engine | None = None
+        # rows of instruments and splits not yet written to db (None: all rows)
+        self._unsaved: dict[str, pd.DataFrame | None] = {}
+        self._change_log: list[pd.DataFrame] = []
+        # journal of price downloads, indexed by InsCode
+        self._price_jobs: pd.DataFrame | None = None
+        self._storage: StorageBackend | None = None
         self._last_possible_deven: str = ""
         self._last_instrument_update: str = ""
+        # jalali dates of converted dates and how many are stored in the cache
+        self._jalali_dates: dict[int, str] = {}
+        self._n_jalali_dates: int = 0
+        # tables are read from db on first access (see _load)
+        self._loaded: set[str] = set()
         self.cache_to_db = (
             self.settings["cache_to_db"] if "cache_to_db" in self.settings else True
         )
+        self.storage_backend = (
+            self.settings["storage_backend"]
+            if "storage_backend" in self.settings
+            else "sqlite"
+        )
+        self.persist_adjusted = (
+            self.settings["persist_adjusted"]
+            if "persist_adjusted" in self.settings
+            else False
+        )
+        # processes to adjust and export prices with
+        self.workers = self.settings["workers"] if "workers" in self.settings else 0
+        # trading sessions, dates of cached prices are added as sessions
+        self.calendar = TradingCalendar(cfg.TSE_HOLIDAYS)
         self._init_cache_dir()
-        self._read_metadata()
-        self._read_instrums()
-        self._read_splits()
+
+    def _load(self, name: str):
+        # read "metadata", "instruments", "last_devens", "splits",
+        # "jalali_dates" or "price_jobs" from db, once.
+
+        if name in self._loaded:
+            return
+        self._loaded.add(name)
+        readers = {
+            "metadata": self._read_metadata,
+            "instruments": self._read_instrums,
+            "last_devens": self._read_last_devens,
+            "splits": self._read_splits,
+            "jalali_dates": self._read_jalali_dates,
+            "price_jobs": self._read_price_jobs,
+        }
+        readers[name]()
 
     def _read_metadata(self):
         # get last_instrument_update and last_possible_deven from database if available.
@@ -62,7 +112,7 @@ class TSECache:
                 self._last_instrument_update = metadata.loc[:, "last_inst_upd"].iloc[-1]
 
     def _init_cache_dir(self):
-        # create cache dir and database file if needed.
+        # create cache dir and storage backend if needed.
 
         if "tse_dir" in self.settings:
             self._data_dir = Path(self.settings["tse_dir"])
@@ -73,21 +123,22 @@ class TSECache:
         if self.cache_to_db:
             self._data_dir.mkdir(parents=True, exist_ok=True)
             tse_logger.info("data dir: %s", self._data_dir)
-        if (
-            self.cache_to_db
-            or (self._data_dir / self.settings["DB_FILE_NAME"]).is_file()
-        ):
-            self._engine = create_engine(
-                "sqlite:///" + str(self._data_dir / self.settings["DB_FILE_NAME"])
-            )
-
-            last_deven_sql = Table(
-                "last_devens",
-                MetaData(),
-                Column("InsCode", BigInteger, primary_key=True),
-                Column("LastDEven", Integer),
-            )
-            last_deven_sql.create(checkfirst=True, bind=self._engine)
+        if self.storage_backend == "parquet":
+            pq_dir = self._data_dir / self.settings["PARQUET_DIR"]
+            if self.cache_to_db or pq_dir.is_dir():
+                self._storage = ParquetStorage(pq_dir)
+        elif self.storage_backend == "sqlite":
+            db_file = self._data_dir / self.settings["DB_FILE_NAME"]
+            if self.cache_to_db or db_file.is_file():
+                pragmas = (
+                    self.settings["SQLITE_PRAGMAS"]
+                    if "SQLITE_PRAGMAS" in self.settings
+                    else None
+                )
+                engine = create_engine("sqlite:///" + str(db_file))
+                self._storage = SQLiteStorage(engine, pragmas)
+        else:
+            raise ValueError(f"Unknown storage backend: {self.storage_backend}")
 
     @property
     def cache_dir(self):
@@ -105,38 +156,176 @@ class TSECache:
         """
         All instruments and their details.
         """
+        self._load("instruments")
         return self._instruments
 
     @instruments.setter
     def instruments(self, value: pd.DataFrame):
         if not value.empty:
+            self._loaded.add("instruments")
             self._instruments = value
+            self._unsaved["instruments"] = None
             self._set_last_inst_upd()
 
+    @property
+    def symbol_index(self) -> dict:
+        """
+        InsCodes (np.ndarray) of each symbol in instruments.
+        It is built again when instruments are replaced or merged.
+        """
+
+        instruments = self.instruments
+        if instruments is None:
+            return {}
+        if self._symbol_index is None or self._symbol_index[0] is not instruments:
+            codes = instruments.index.to_numpy()
+            positions = instruments.groupby("Symbol", sort=False).indices
+            index = {sym: codes[pos] for sym, pos in positions.items()}
+            self._symbol_index = (instruments, index)
+        return self._symbol_index[1]
+
     def _set_last_inst_upd(self):
         # update last_instrument_update
         today = date.today().strftime("%Y%m%d")
-        if self._last_instrument_update != today:
+        if self.last_instrument_update != today:
             self.last_instrument_update = today
 
     @property
     def splits(self):
         """Data about stock splits"""
+        self._load("splits")
         return self._splits
 
     @splits.setter
     def splits(self, value: pd.DataFrame):
         if not value.empty:
+            self._loaded.add("splits")
             self._splits = value
+            self._unsaved["splits"] = None
+
+    def merge_instruments(self, value: pd.DataFrame) -> pd.DataFrame:
+        """
+        Add new instruments and update changed ones, keyed by InsCode.
+
+        :value: pd.DataFrame, instruments indexed by InsCode
+
+        :return: pd.DataFrame, change log of the merged instruments
+        """
+
+        changes = self._merge_table("instruments", value)
+        if not value.empty:
+            self._set_last_inst_upd()
+        return changes
+
+    def merge_splits(self, value: pd.DataFrame) -> pd.DataFrame:
+        """
+        Add new splits and update changed ones, keyed by InsCode and DEven.
+
+        :value: pd.DataFrame, splits indexed by InsCode and DEven
+
+        :return: pd.DataFrame, change log of the merged splits
+        """
+
+        return self._merge_table("splits", value)
+
+    def _merge_table(self, t_name: str, value: pd.DataFrame) -> pd.DataFrame:
+        # upsert rows of instruments or splits and log the changed ones.
+        # rows of a changed key replace all old rows with that key.
+
+        old = getattr(self, t_name)
+        if old is None or old.empty:
+            is_new = np.full(len(value), True)
+            changed = value
+            merged = value
+        else:
+            is_new = ~value.index.isin(old.index)
+            old_rows = old[~old.index.duplicated(keep="last")].reindex(
+                index=value.index, columns=value.columns
+            )
+            differs = (value != old_rows) & ~(value.isna() & old_rows.isna())
+            is_changed = is_new | differs.any(axis=1).to_numpy()
+            is_new = is_new[is_changed]
+            changed = value[is_changed]
+            merged = pd.concat([old[~old.index.isin(changed.index)], changed])
+        if "DEven" in changed.columns:
+            devens = changed["DEven"].to_numpy()
+        else:
+            devens = changed.index.get_level_values("DEven")
+        change_log = pd.DataFrame(
+            {
+                "Updated": int(date.today().strftime("%Y%m%d")),
+                "Table": t_name,
+                "InsCode": changed.index.get_level_values("InsCode"),
+                "DEven": devens,
+                "Change": np.where(is_new, "insert", "update"),
+            },
+            columns=cfg.change_log_info,
+        ).set_index(cfg.change_log_info[:-1])
+        change_log = change_log[~change_log.index.duplicated(keep="last")]
+        if changed.empty:
+            return change_log
+        setattr(self, f"_{t_name}", merged)
+        unsaved = self._unsaved.get(t_name, changed.iloc[:0])
+        if unsaved is not None:
+            unsaved = unsaved[~unsaved.index.isin(changed.index)]
+            self._unsaved[t_name] = pd.concat([unsaved, changed])
+        self._change_log.append(change_log)
+        return change_log
+
+    def read_change_log(self, since: int = 0) -> pd.DataFrame:
+        """
+        Changes of instruments and splits, e.g. to refresh downstream data.
+
+        :since: int, first date (yyyymmdd) of updates to return
+
+        :return: pd.DataFrame, "Change" ("insert" or "update") of each row of
+            a table, indexed by update date, table name, InsCode and DEven
+        """
+
+        key = cfg.change_log_info[:-1]
+        logs = [*self._change_log]
+        stored = self._read_table("change_log", index_col=key)
+        if stored is not None:
+            logs.insert(0, stored)
+        if not logs:
+            return pd.DataFrame(
+                columns=["Change"],
+                index=pd.MultiIndex.from_arrays([[]] * len(key), names=key),
+            )
+        change_log = pd.concat(logs)
+        change_log = change_log[~change_log.index.duplicated(keep="last")]
+        updated = change_log.index.get_level_values("Updated")
+        return change_log[updated >= int(since)].sort_index()
 
     @property
     def prices(self):
         """Price data indexed by code and date. Can be None or pd.DataFrame"""
+        prices = self._sorted_prices()
+        return None if prices is None else prices.copy()
+
+    def _sorted_prices(self) -> pd.DataFrame | None:
+        # internal price data sorted by code and date, not to be modified.
+
+        self._consolidate_prices()
         if self._prices is not None:
             if not self._prices.empty:
-                return self._prices.sort_index()
+                return self._prices
         return None
 
+    def _consolidate_prices(self) -> None:
+        # merge buffered blocks into the sorted price data with a single concat.
+
+        if not self._prices_blocks:
+            return
+        blocks = self._prices_blocks
+        if self._prices is not None:
+            blocks = [self._prices, *blocks]
+        prices = pd.concat(blocks)
+        # newer rows replace older ones for the same code and date
+        prices = prices[~prices.index.duplicated(keep="last")]
+        self._prices = prices.sort_index()
+        self._prices_blocks = []
+
     @property
     def prices_merged(self):
         """Price data indexed by symbol an date. Can be None or pd.DataFrame"""
@@ -147,6 +336,7 @@ class TSECache:
     def add_to_prices(self, dfs: list[pd.DataFrame]) -> bool:
         """
         Adds a list of dataframes to "prices" property.
+        New data is buffered and merged once, when "prices" is read.
 
         :dframes: list[pd.DataFrame], list of dataframes to add to prices property.
 
@@ -155,59 +345,96 @@ class TSECache:
 
         dfs = [data for data in dfs if not data.empty]
 
+        new_prices = None
         if dfs:
-            new_prices = pd.concat(dfs)
-            if self._prices is None:
-                self._prices = new_prices
-            else:
-                self._prices = pd.concat([new_prices, self._prices])
-            if self.cache_to_db:
-                self._prices_to_db(new_prcs=new_prices)
-            return True
-        else:
-            return False
+            new_prices = dfs[0] if len(dfs) == 1 else pd.concat(dfs)
+            self._prices_blocks.append(new_prices)
+            self.calendar.add_sessions(new_prices.index.unique("DEven"))
+        if self.cache_to_db:
+            # also stores last_devens of codes without new prices
+            self._prices_to_db(new_prcs=new_prices)
+        return bool(dfs)
 
     @property
     def last_instrument_update(self):
         """last date of updating list of instrument and splits"""
+        self._load("metadata")
         return self._last_instrument_update
 
     @last_instrument_update.setter
     def last_instrument_update(self, value: str):
         if value:
+            self._load("metadata")
             self._last_instrument_update = value
 
-    def read_prices(self, codes: list[int]):
+    def read_prices(
+        self,
+        codes: list[int],
+        end_date: int | None = None,
+        columns: list[str] | None = None,
+    ):
         """
-        updates a dicts of prices for ins_codes in self.prices
+        updates a dicts of prices for ins_codes in self.prices.
+        prices of other codes are kept.
+
+        :codes: list[int], codes to read prices of
+        :end_date: int, last date to read. default: "end_date" setting
+        :columns: list[str], columns to return from prices_by_symbol (the columns
+            needed for adjusting are read too). default: "price_columns" setting
         """
 
-        if self._engine:
-            prices = self._read_prc(codes=codes)
+        if self._storage is not None:
+            prices = self._read_prc(codes=codes, end_date=end_date, columns=columns)
             if (prices is not None) and (not prices.empty):
-                self._prices = prices.sort_index()
+                self.calendar.add_sessions(prices.index.unique("DEven"))
+                if self._prices is None and not self._prices_blocks:
+                    self._prices = prices.sort_index()
+                else:
+                    # rows in memory are newer than the stored ones
+                    self._consolidate_prices()
+                    self._prices_blocks = [self._prices]
+                    self._prices = prices.sort_index()
 
-    def _read_prc(self, codes: list[int]) -> pd.DataFrame | None:
+    def _read_prc(
+        self,
+        codes: list[int],
+        end_date: int | None = None,
+        columns: list[str] | None = None,
+    ) -> pd.DataFrame | None:
         """
-        Read selected instruments files from the cache dir and return a pd.DataFrame.
+        Read selected instruments from the storage and return a pd.DataFrame.
+        Only the rows up to end_date and the needed columns are read.
 
         :codes: list[int], list of codes to read from.
+        :end_date: int, last date to read. default: "end_date" setting
+        :columns: list[str], price columns to return. default: "price_columns" setting
 
         :return: pd.DataFrame
         """
 
-        table_name = "daily_prices"
-        if inspect(self._engine).has_table(table_name):
-            prcs_table = Table(table_name, MetaData(), autoload_with=self._engine)
-            qry = select(prcs_table).where(
-                prcs_table.c.InsCode.in_(codes) & prcs_table.c.DEven
-                >= int(self.settings["start_date"])
-            )
-            with self._engine.connect() as conn:
-                data = pd.read_sql_query(qry, conn, index_col=["InsCode", "DEven"])
-            return data
-        else:
-            return None
+        if end_date is None:
+            end_date = self._end_date
+        if columns is None and "price_columns" in self.settings:
+            columns = self.settings["price_columns"]
+        if columns is not None:
+            columns = [
+                col
+                for col in cfg.tse_closing_prices_info[2:]
+                if col in columns or col in REQUIRED_PRICE_COLS
+            ]
+        return self._storage.read_prices(
+            codes=codes,
+            start_date=int(self.settings["start_date"]),
+            end_date=end_date,
+            columns=columns,
+        )
+
+    @property
+    def _end_date(self) -> int | None:
+        # last date of prices to use
+        if "end_date" in self.settings and self.settings["end_date"]:
+            return int(self.settings["end_date"])
+        return None
 
     def _read_instrums(self):
         # read list of all cached instruments from db and update "instruments"
@@ -216,10 +443,18 @@ class TSECache:
         instrums = self._read_table(table_name=ins_tbl_name, index_col=["InsCode"])
         if (instrums is not None) and (not instrums.empty):
             self._instruments = instrums
+
+    def _read_last_devens(self):
+        # read last downloaded and checked dates of prices from db
+
         lds_tbl_name = "last_devens"
         last_devens = self._read_table(table_name=lds_tbl_name, index_col=["InsCode"])
         if (last_devens is not None) and (not last_devens.empty):
-            self._last_devens = last_devens
+            if "LastChecked" not in last_devens.columns:
+                # older versions stored the date of the last check as LastDEven
+                last_devens["LastChecked"] = last_devens["LastDEven"]
+            last_devens = last_devens[["LastDEven", "LastChecked"]]
+            self._last_devens = last_devens.apply(pd.to_numeric).astype("Int64")
 
     def _read_splits(self):
         # read stock splits from database and update splits property.
@@ -229,22 +464,58 @@ class TSECache:
         if (splits is not None) and (not splits.empty):
             self._splits = splits
 
+    def _read_jalali_dates(self):
+        # read converted dates from database to skip converting them again.
+
+        dates = self._read_table(table_name="jalali_dates", index_col=["DEven"])
+        if (dates is not None) and (not dates.empty):
+            dates = dates["date_jalali"]
+            self._jalali_dates.update(zip(dates.index.astype("int64"), dates))
+            self._n_jalali_dates = len(dates)
+
+    def _read_price_jobs(self):
+        # read the journal of price downloads from database
+
+        jobs = self._read_table("price_jobs", index_col=cfg.price_jobs_info[:1])
+        if jobs is not None and not jobs.empty:
+            if "Attempts" not in jobs:
+                # journal of an older version: unfinished jobs were started once
+                jobs["Attempts"] = 1
+                self._storage.write_table(
+                    "price_jobs", jobs, index_label=cfg.price_jobs_info[0]
+                )
+            self._price_jobs = jobs
+
+    def _jalali_dates_to_db(self):
+        # store converted dates if new dates were converted.
+
+        if self.cache_to_db:
+            if len(self._jalali_dates) > self._n_jalali_dates:
+                dates = pd.Series(
+                    self._jalali_dates, name="date_jalali", dtype=object
+                ).to_frame()
+                self._storage.write_table("jalali_dates", dates, index_label="DEven")
+                self._n_jalali_dates = len(dates)
+
     @property
     def last_possible_deven(self):
         """
         last update date
         """
+        self._load("metadata")
         return self._last_possible_deven
 
     @last_possible_deven.setter
     def last_possible_deven(self, value: str):
         if value:
+            self._load("metadata")
             self._last_possible_deven = value
 
     def _upd_metadata(self):
         # update "metadata" table in db
 
         if self.cache_to_db:
+            self._load("metadata")
             t_name = "metadata"
             metadata = pd.DataFrame.from_dict(
                 {
@@ -252,20 +523,14 @@ class TSECache:
                     "last_inst_upd": [self._last_instrument_update],
                 }
             )
-            with self._engine.connect() as conn:
-                metadata.to_sql(t_name, conn, if_exists="replace")
+            self._storage.write_table(t_name, metadata, index_label="index")
 
     def _read_table(self, table_name: str, index_col: list[str]) -> pd.DataFrame | None:
         # read a table from db and return its data
 
-        if self._engine is not None and inspect(self._engine).has_table(table_name):
-            with self._engine.connect() as conn:
-                data = pd.read_sql_table(
-                    table_name=table_name, con=conn, index_col=index_col
-                )
-            return data
-        else:
-            return
+        if self._storage is not None:
+            return self._storage.read_table(table_name=table_name, index_col=index_col)
+        return None
 
     def prices_by_symbol(self, symbols: list[str], cols: list[str]) -> dict:
         """
@@ -277,33 +542,27 @@ class TSECache:
         :return: dict, dict with symbols as keys and prices (DataFrame) as values
         """
 
-        if self._prices is None or self._instruments is None:
+        if self._sorted_prices() is None or self.instruments is None:
             raise AttributeError("Some required data is missing in cache.")
-        if not cols or "date_jalali" in cols:
-            self._prices.loc[:, "date_jalali"] = self._prices.index.get_level_values(
-                "DEven"
-            ).map(to_jalali_date)
 
-        symbol_dict = {
-            symbol: list(
-                self.instruments[self.instruments["Symbol"].isin([symbol])].index
-            )
-            for symbol in symbols
-        }
-
-        prices_merged_lst = []
-        for sym, sym_codes in symbol_dict.items():
-            prices_merged_lst.append(
-                pd.concat(
-                    {
-                        sym: self.adjust(
-                            self.settings["adjust_prices"], sym_codes
-                        ).reset_index(level=[0])
-                    },
-                    names=["Symbol"],
-                )
+        index = self.symbol_index
+        found = [symbol for symbol in dict.fromkeys(symbols) if symbol in index]
+        sym_codes = [index[symbol] for symbol in found]
+        # symbol of each code, joined to prices in one pass by the adjuster
+        groups = pd.Series(
+            np.repeat(np.array(found, dtype=object), [len(c) for c in sym_codes]),
+            index=np.concatenate(sym_codes) if sym_codes else [],
+            name="Symbol",
+            dtype=object,
+        )
+        adjusted = self._adjust_cached(groups, self.settings["adjust_prices"])
+        self._prices_merged = adjusted.set_index(["Symbol", "DEven"])
+        if not cols or "date_jalali" in cols:
+            self._load("jalali_dates")
+            self._prices_merged["date_jalali"] = to_jalali_dates(
+                self._prices_merged.index.get_level_values("DEven"), self._jalali_dates
             )
-        self._prices_merged = pd.concat(prices_merged_lst).sort_index()
+            self._jalali_dates_to_db()
         if not self.settings["days_without_trade"]:
             self._prices_merged = self._prices_merged[
                 self._prices_merged["ZTotTran"] > 0
@@ -311,9 +570,127 @@ class TSECache:
         if cols:
             self._prices_merged = self._prices_merged[cols]
 
-        grouper = "Symbol"
-        prices = dict(tuple(self._prices_merged.groupby(grouper)))
-        return prices
+        # rows of a symbol are already sorted by date, no need to sort all rows
+        positions = self._prices_merged.groupby(level="Symbol", sort=False).indices
+        return {
+            symbol: self._prices_merged.iloc[positions[symbol]]
+            for symbol in sorted(positions)
+        }
+
+    def _adjust_cached(self, groups: pd.Series, cond: int) -> pd.DataFrame:
+        """
+        Adjust prices of groups of codes. Adjusted series of a group are reused
+        until prices or splits of its codes change.
+
+        :groups: pd.Series, group (symbol) of each InsCode
+        :cond: int, price adjust type. can be 0 (no adjustment), 1, 2 or 3
+
+        :return: pd.DataFrame, adjusted prices (see price_adjuster.adjust_prices)
+        """
+
+        prices = self._sorted_prices()
+        prices = prices[prices.index.isin(groups.index, level="InsCode")]
+        if self._end_date is not None:
+            prices = prices[prices.index.get_level_values("DEven") <= self._end_date]
+        # versions: last date, number of rows and content hash of each code,
+        # last split id. the hash catches prices corrected without new rows.
+        code_stats = (
+            prices.index.to_frame(index=False)
+            .groupby("InsCode")["DEven"]
+            .agg(["max", "size"])
+        )
+        code_stats["hash"] = self._price_hashes.reindex(code_stats.index)
+        stats = dict(
+            zip(
+                code_stats.index,
+                zip(code_stats["max"], code_stats["size"], code_stats["hash"]),
+            )
+        )
+        split_ids = {}
+        if self.splits is not None and "Idn" in self.splits:
+            split_ids = self.splits.groupby(level="InsCode")["Idn"].max().to_dict()
+
+        cached, missing = [], []
+        for sym, sym_codes in groups.groupby(groups, sort=False):
+            codes = sorted(sym_codes.index)
+            key = (tuple(codes), cond)
+            version = repr([(stats.get(code), split_ids.get(code)) for code in codes])
+            data = self._get_adjusted(key, version)
+            if data is None:
+                missing.append(sym)
+            else:
+                cached.append(data.assign(Symbol=sym))
+
+        if missing:
+            miss_groups = groups[groups.isin(missing)]
+            adjust_args = dict(
+                prices=prices[prices.index.isin(miss_groups.index, level="InsCode")],
+                groups=miss_groups,
+                cond=cond,
+                splits=self.splits,
+                nominal_prices=self.settings["NOMINAL_PRICES"],
+            )
+            if self.workers > 1:
+                adjusted = adjust_prices_parallel(**adjust_args, workers=self.workers)
+            else:
+                adjusted = adjust_prices(**adjust_args)
+            for sym, data in adjusted.groupby("Symbol", sort=False):
+                codes = sorted(miss_groups[miss_groups == sym].index)
+                version = repr(
+                    [(stats.get(code), split_ids.get(code)) for code in codes]
+                )
+                self._set_adjusted((tuple(codes), cond), version, data)
+            cached.append(adjusted)
+        if not cached:
+            return adjust_prices(prices, groups, cond)
+        return pd.concat(cached, ignore_index=True)
+
+    @property
+    def _price_hashes(self) -> pd.Series:
+        # content hash of the prices of each code, computed once per price frame
+
+        self._consolidate_prices()
+        prices = self._prices
+        if self._prices_hash is None or self._prices_hash[0] is not prices:
+            hashes = pd.util.hash_pandas_object(prices, index=True).to_numpy()
+            codes = prices.index.get_level_values("InsCode").to_numpy()
+            # prices are sorted by code, sums of row hashes wrap around
+            starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+            code_hashes = pd.Series(
+                np.add.reduceat(hashes, starts), index=codes[starts]
+            )
+            self._prices_hash = (prices, code_hashes)
+        return self._prices_hash[1]
+
+    def _get_adjusted(self, key: tuple, version: str) -> pd.DataFrame | None:
+        # get adjusted prices from memory or storage, if still valid
+
+        if key in self._adjusted:
+            cached_version, data = self._adjusted[key]
+            if cached_version == version:
+                self._adjusted.move_to_end(key)
+                return data
+            del self._adjusted[key]
+        if self.persist_adjusted and self._storage is not None:
+            codes, cond = key
+            stored = self._storage.read_adjusted(cond, ",".join(map(str, codes)))
+            if stored is not None and stored[0] == version:
+                self._set_adjusted(key, version, stored[1], persist=False)
+                return stored[1]
+        return None
+
+    def _set_adjusted(
+        self, key: tuple, version: str, data: pd.DataFrame, persist: bool = True
+    ):
+        # keep adjusted prices, evicting the least recently used ones
+
+        self._adjusted[key] = (version, data)
+        self._adjusted.move_to_end(key)
+        while len(self._adjusted) > self.settings["ADJUSTED_CACHE_SIZE"]:
+            self._adjusted.popitem(last=False)
+        if persist and self.persist_adjusted and self._storage is not None:
+            codes, cond = key
+            self._storage.write_adjusted(cond, ",".join(map(str, codes)), version, data)
 
     def adjust(self, cond: int, ins_codes: list[int]) -> pd.DataFrame:
         """
@@ -324,228 +701,188 @@ class TSECache:
         3: adjust according to cash dividends
 
         :cond: int, price adjust type. can be 0 (no adjustment), 1, 2 or 3
-        :ins_codes: list, instrument codes
+        :ins_codes: list, instrument codes of one stock
 
         :return: pd.DataFrame, adjusted closing prices
 
         :raises: ValueError, if there is no price data in cache
         """
 
-        if self.prices is not None:
-            prices = self.prices[
-                self.prices.index.isin(ins_codes, level="InsCode")
-            ].sort_index(level=1)
-            cp_len = len(prices)
-            if cp_len < 2:
-                return prices
-            price_cols = list(prices.columns)
-            if len(ins_codes) > 1:
-                # find stock moves between markets
-                # and adjust for nominal price in the new market, if necessary
-                prices["ShiftedClose"] = prices["PClosing"].shift(1)
-                nom_idxs = prices.groupby("InsCode").head(1).index[1:]
-                default_prs = self.settings["NOMINAL_PRICES"]
-                prices["nom_pr"] = (
-                    prices["PClosing"].isin(default_prs)
-                    & prices.index.isin(nom_idxs)
-                    & (prices["ShiftedClose"] != prices["PriceYesterday"])
-                )
-                while not prices[prices["nom_pr"]].empty:
-                    # index of first and last row with nominal price
-                    first_idx = prices[prices["nom_pr"]].index[0]
-                    cond_1 = prices.index.isin([first_idx[0]], level="InsCode")
-                    cond_2 = prices["QTotTran5J"] != 0
-                    last_idx = prices.loc[cond_1 & cond_2].index[0]
-
-                    # the price to replace nominal price
-                    rep_pr = prices.loc[first_idx, "ShiftedClose"]
-
-                    prices.loc[first_idx:last_idx, "PClosing"].iloc[:-1] = rep_pr
-                    prices.loc[first_idx:last_idx, "PriceYesterday"] = rep_pr
-                    prices.loc[first_idx:last_idx, "nom_pr"].iloc[0] = False
-            if not cond:
-                return prices
-            if cond in [1, 3]:
-                prices["ShiftedYDay"] = prices["PriceYesterday"].shift(-1)
-                prices["AdjMultiplr"] = (
-                    prices["ShiftedYDay"] / prices["PClosing"]
-                ).fillna(1)
-            if cond in [2, 3]:
-                if (self._splits is not None) and (not self._splits.empty):
-                    filtered_splits = self._splits.loc[ins_codes].eval(
-                        expr="SplitMultiplr = NumberOfShareOld / NumberOfShareNew"
-                    )
-                    prices = prices.join(filtered_splits[["SplitMultiplr"]]).fillna(1)
-                else:
-                    prices["SplitMultiplr"] = 1
-            if cond == 1:
-                prices["AdjMultiplrCumProd"] = (
-                    prices.AdjMultiplr.iloc[::-1].cumprod().iloc[::-1]
-                )
-                prices["AdjPClosing"] = (
-                    prices.AdjMultiplrCumProd * prices.PClosing
-                ).map(round)
-            elif cond == 2:
-                prices["SplitMultiplrCumProd"] = (
-                    prices.SplitMultiplr.iloc[::-1]
-                    .cumprod()
-                    .iloc[::-1]
-                    .shift(-1, fill_value=1)
-                )
-                prices["AdjPClosing"] = (
-                    prices.SplitMultiplrCumProd * prices.PClosing
-                ).map(round)
-            elif cond == 3:
-                prices["DividMultiplr"] = prices["AdjMultiplr"]
-                prices.loc[
-                    ~prices["SplitMultiplr"].shift(-1).isin([1]),
-                    "DividMultiplr",
-                ] = 1
-                prices["DividMultiplrCumProd"] = (
-                    prices.DividMultiplr.iloc[::-1].cumprod().iloc[::-1]
-                )
-                prices["AdjPClosing"] = (
-                    prices.DividMultiplrCumProd * prices.PClosing
-                ).map(round)
-            price_cols.append("AdjPClosing")
-            return prices[price_cols]
-        else:
+        prices = self._sorted_prices()
+        if prices is None:
             raise ValueError("No price data available.")
+        prices = prices[prices.index.isin(ins_codes, level="InsCode")]
+        groups = pd.Series(0, index=pd.Index(ins_codes), name="Group")
+        adjusted = adjust_prices(
+            prices=prices,
+            groups=groups,
+            cond=cond,
+            splits=self.splits,
+            nominal_prices=self.settings["NOMINAL_PRICES"],
+        )
+        return adjusted.drop(columns="Group").set_index(["InsCode", "DEven"])
 
     def write_prc_csv(
         self,
         prices: dict,
     ) -> None:
         """
-        Write price data to a csv file or a list of csv files.
+        Export price data to one file per symbol. files that are already exported
+        only get their new rows.
 
         :prices: dict, dict of price data for symbols
         """
 
-        if self.prices is not None:
-            tse_logger.info("Writing data to csv files.")
-            for sym, sym_prcs in track(prices.items(), description="Writing data"):
-                prc_data = sym_prcs
-                f_name = sym
-                self._write_tse_csv(
-                    f_name=f_name,
-                    data=prc_data,
-                    subdir=self.settings["PRICES_DIR"],
-                )
-            tse_logger.info("writing to csv finished")
-
-    def _write_tse_csv(self, f_name: str, data: pd.DataFrame, **kwargs):
-        """
-        Write data to csv file.
-
-        :f_name: str, File name
-        :data: pd.DataFrame, Stock price data
-        """
-
-        if "subdir" in kwargs:
-            tse_dir = self._data_dir / str(kwargs.get("subdir"))
-        else:
-            tse_dir = self._data_dir
-        if not tse_dir.is_dir():
-            tse_dir.mkdir(parents=True, exist_ok=True)
-        if len(data) == 0:
+        if self._sorted_prices() is None:
             return
-        file_path = tse_dir / f"{f_name}.csv"
-        data.to_csv(file_path, encoding="utf-8")
+        directory = self._data_dir / self.settings["PRICES_DIR"]
+        if self.workers > 1:
+            tse_logger.info("Writing data to files in %s processes.", self.workers)
+            counts = write_files_parallel(
+                prices,
+                directory,
+                self._export_format,
+                workers=self.workers,
+                progress=True,
+            )
+        else:
+            tse_logger.info("Writing data to files.")
+            threads = self.settings.get("export_threads", 0)
+            exporter = PriceExporter(
+                directory, self._export_format, threads, progress=True
+            )
+            counts = exporter.export(prices)
+        tse_logger.info(
+            "writing to files finished, %s rows in %s files",
+            sum(counts.values()),
+            sum(1 for count in counts.values() if count),
+        )
+
+    @property
+    def _export_format(self) -> str:
+        # format of exported price files
+        if "export_format" in self.settings:
+            return self.settings["export_format"]
+        return "csv"
 
     def _prices_to_db(self, new_prcs):
         # write cached price data to database.
 
-        def sqlite_upsert(table, conn, keys, data_iter):
-            """
-            update columns on primary key conflict
-            """
-            data = [dict(zip(keys, row)) for row in data_iter]
-            insert_stmt = insert(table.table).values(data)
-            upsert_stmt = insert_stmt.on_conflict_do_update(
-                index_elements=table.index,
-                set_={
-                    c.name: c for c in insert_stmt.excluded if not c.name in table.index
-                },
-            )
-            result = conn.execute(upsert_stmt)
-            return result.rowcount
-
-        if self._prices is not None and not self._prices.empty:
-            t_name = "daily_prices"
-            with self._engine.connect() as conn:
-                new_prcs.to_sql(
-                    name=t_name,
-                    con=conn,
-                    if_exists="append",
-                    index=True,
-                    method="multi",
-                    chunksize=5000,
-                    index_label=["InsCode", "DEven"],
-                )
-
-        if self._last_devens is not None:
-            t_name = "last_devens"
-            with self._engine.connect() as conn:
-                self.last_devens.to_sql(
-                    name=t_name,
-                    con=conn,
-                    if_exists="append",
-                    method=sqlite_upsert,
-                    chunksize=4000,
-                    index_label=["InsCode"],
-                )
+        if new_prcs is not None and not new_prcs.empty:
+            self._storage.write_prices(new_prcs)
+        # only the rows changed since the last write
+        last_devens = self._unsaved.pop("last_devens", None)
+        if last_devens is not None:
+            self._storage.write_last_devens(last_devens)
 
     def instruments_to_db(self):
         """
-        write cached instruments and splits data to database file
+        write cached instruments and splits data to database file.
+        merged rows are upserted, assigned tables are written as a whole.
         """
 
-        if self._instruments is not None and not self._instruments.empty:
-            t_name = "instruments"
-            with self._engine.connect() as conn:
-                self._instruments.to_sql(
-                    name=t_name,
-                    con=conn,
-                    if_exists="replace",
-                    index=True,
-                    method="multi",
-                    index_label="InsCode",
-                )
-        if self._splits is not None and not self._splits.empty:
-            t_name = "splits"
-            with self._engine.connect() as conn:
-                self._splits.to_sql(
-                    name=t_name,
-                    con=conn,
-                    if_exists="replace",
-                    index=True,
-                    method="multi",
-                    index_label=["InsCode", "DEven"],
-                )
+        index_labels = {"instruments": "InsCode", "splits": ["InsCode", "DEven"]}
+        for t_name, index_label in index_labels.items():
+            if t_name not in self._unsaved:
+                continue
+            rows = self._unsaved.pop(t_name)
+            data = getattr(self, t_name)
+            if rows is not None:
+                self._storage.upsert_table(t_name, rows, index_label=index_label)
+            elif data is not None and not data.empty:
+                self._storage.write_table(t_name, data, index_label=index_label)
+        if self._change_log:
+            self._storage.upsert_table(
+                "change_log",
+                pd.concat(self._change_log),
+                index_label=cfg.change_log_info[:-1],
+            )
+            self._change_log = []
         self._upd_metadata()
 
+    @property
+    def price_jobs(self) -> pd.DataFrame:
+        """
+        Journal of price downloads. "Chunk", date to download from ("DEven"),
+        "NotInNoMarket", "Status" (see cfg.JOB_*) and number of updates that
+        started the job ("Attempts") of each InsCode. "Chunk" is -1 for codes
+        that had no new sessions to download.
+        """
+
+        self._load("price_jobs")
+        if self._price_jobs is None:
+            return pd.DataFrame(
+                columns=cfg.price_jobs_info[1:],
+                index=pd.Index([], name=cfg.price_jobs_info[0], dtype="int64"),
+            )
+        return self._price_jobs
+
+    def set_price_jobs(self, changed: pd.DataFrame) -> None:
+        """
+        Add or update jobs of the price download journal. changed jobs are
+        written to db at once, so an interrupted download can be resumed.
+
+        :changed: pd.DataFrame, jobs indexed by InsCode (see price_jobs)
+        """
+
+        jobs = self.price_jobs
+        if not jobs.empty:
+            jobs = pd.concat([jobs[~jobs.index.isin(changed.index)], changed])
+        self._price_jobs = changed if jobs.empty else jobs
+        if self.cache_to_db:
+            self._storage.upsert_table(
+                "price_jobs", changed, index_label=cfg.price_jobs_info[0]
+            )
+
     @property
     def last_devens(self):
         """
         get last cheched date for each price data.
         """
+        self._load("last_devens")
         return self._last_devens
 
-    def update_last_devens(self, codes: list[int]):
+    def update_last_devens(
+        self, codes: list[int], new_prices: pd.DataFrame | None = None
+    ):
         """
-        update last_devens table
+        update last_devens table. "LastDEven" is the last downloaded date of
+        each code, "LastChecked" the last session known to the server
+        (last_possible_deven) when its prices were checked.
 
-        :param codes: list[int], codes which their last_devens has to be added/updated.
+        :param codes: list[int], codes which their prices are checked today.
+        :param new_prices: pd.DataFrame, downloaded prices indexed by InsCode and DEven
         """
-        if codes:
-            today = date.today().strftime("%Y%m%d")
-            if self._last_devens is None:
-                self._last_devens = pd.DataFrame(
-                    today, index=codes, columns=["LastDEven"]
-                )
-            else:
-                self._last_devens = self._last_devens.reindex(
-                    codes + list(self._last_devens.index)
-                )
-                self._last_devens.loc[codes, "LastDEven"] = today
+        if not len(codes):
+            return
+        self._load("last_devens")
+        index = pd.Index(codes, name="InsCode").unique()
+        last_devens = pd.Series(pd.NA, index=index, dtype="Int64")
+        if self._last_devens is not None:
+            last_devens = self._last_devens["LastDEven"].reindex(index)
+        if new_prices is not None and not new_prices.empty:
+            downloaded = (
+                new_prices.index.to_frame(index=False).groupby("InsCode")["DEven"].max()
+            )
+            last_devens = pd.concat(
+                [last_devens, downloaded.reindex(index)], axis=1
+            ).max(axis=1)
+        # not the date of the check: a session published later is still missing
+        checked = self.last_possible_deven or date.today().strftime("%Y%m%d")
+        rows = pd.DataFrame(
+            {
+                "LastDEven": last_devens.astype("Int64"),
+                "LastChecked": int(checked),
+            },
+            index=index,
+        ).astype("Int64")
+        if self._last_devens is None:
+            self._last_devens = rows
+        else:
+            old = self._last_devens
+            self._last_devens = pd.concat([old[~old.index.isin(index)], rows])
+        if self.cache_to_db:
+            unsaved = self._unsaved.get("last_devens")
+            if unsaved is not None:
+                rows = pd.concat([unsaved[~unsaved.index.isin(index)], rows])
+            self._unsaved["last_devens"] = rows
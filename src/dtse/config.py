@@ -10,8 +10,18 @@ storage = dict(
     TSE_CACHE_DIR="tse_data",
     PRICES_DIR="prices",
     DB_FILE_NAME="tse_data.sqlite3",
+    PARQUET_DIR="parquet",  # used by the "parquet" storage backend
+    ADJUSTED_CACHE_SIZE=512,  # adjusted series kept in memory
     NOMINAL_PRICES=[1000, 0],
     DEF_START=20110101,  # maybe 20081206
+    # applied to every connection to the cache database
+    SQLITE_PRAGMAS=dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        mmap_size=256 * 1024 * 1024,  # bytes
+        cache_size=-64 * 1024,  # negative values are KiB
+        temp_store="MEMORY",
+    ),
 )
 
 # data sructures
@@ -63,30 +73,92 @@ tse_closing_prices_info = [
     "PriceYesterday",
     "PriceFirst",
 ]
+# compact dtypes of daily prices (columns of tse_closing_prices_info), used when
+# parsing responses and reading the cache.
+# precision policy: prices (rials), counts and volumes are whole numbers, so they
+# are kept in integer dtypes, which are exact. prices are int64, so no price is
+# too large. every block of prices gets these dtypes, columns with missing values
+# get their nullable version (e.g. "Int64") and keep them missing. fractions or
+# values out of range raise a ValueError (see tse_utils.to_prices_dtypes).
+# float32 is never used: it rounds prices above 2**24 (16.7M) rials.
+tse_closing_prices_dtypes = {
+    "InsCode": "int64",
+    "DEven": "int32",
+    "PClosing": "int64",
+    "PDrCotVal": "int64",
+    "ZTotTran": "uint32",
+    "QTotTran5J": "int64",
+    "QTotCap": "int64",
+    "PriceMin": "int64",
+    "PriceMax": "int64",
+    "PriceYesterday": "int64",
+    "PriceFirst": "int64",
+}
+# changes of instruments and splits, keyed by all columns but "Change"
+change_log_info = ["Updated", "Table", "InsCode", "DEven", "Change"]
+# journal of price downloads: chunk, date to download from, status and number of
+# updates that started the job of each code
+price_jobs_info = ["InsCode", "Chunk", "DEven", "NotInNoMarket", "Status", "Attempts"]
+JOB_PENDING = "pending"
+JOB_IN_FLIGHT = "in_flight"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_DROPPED = "dropped"  # not resumed anymore, see PRICES_UPDATE_MAX_ATTEMPTS
 
 RESP_LN_TERMINATOR = ";"
 
 # data services
 UPDATE_INTERVAL = 1
 PRICES_UPDATE_CHUNK = 50
-PRICES_UPDATE_CHUNK_DELAY = 0.5
+PRICES_UPDATE_CHUNK_DELAY = 0.5  # min seconds between two requests (1 / rps budget)
 PRICES_UPDATE_RETRY_COUNT = 3
 PRICES_UPDATE_RETRY_DELAY = 1
+# updates that resume an unfinished job before it is dropped from the journal
+PRICES_UPDATE_MAX_ATTEMPTS = 3
+# adaptive (AIMD) limit for in-flight price requests
+PRICES_UPDATE_CONCURRENCY = 4  # initial limit
+PRICES_UPDATE_MIN_CONCURRENCY = 1
+PRICES_UPDATE_MAX_CONCURRENCY = 16
+PRICES_UPDATE_TARGET_LATENCY = 5  # seconds. slower responses shrink the limit
+PRICES_UPDATE_BACKOFF_FACTOR = 0.5  # multiply the limit by this on errors
 default_settings = {
     "columns": [0, 2, 3, 4, 5, 6, 7, 8, 9],
     "adjust_prices": 0,
     "days_without_trade": False,
     "start_date": "20120321",
+    "end_date": None,  # last date of prices, None for the last available date
+    "price_columns": None,  # columns of prices to return, None for all columns
     "merge_similar_symbols": True,
     "cache_to_db": True,
+    "storage_backend": "sqlite",  # or "parquet" (needs pyarrow)
+    "persist_adjusted": False,  # also keep adjusted prices in the cache storage
+    # settings of the limiter of price requests (see AdaptiveLimiter), e.g.
+    # {"min_interval": 1}. None to use PRICES_UPDATE_* below
+    "price_requests": None,
     "write_csv": True,
+    "export_format": "csv",  # "csv.gz", "parquet" or "feather" (need pyarrow)
+    "export_threads": 4,  # threads exporting files, 0 to use none
+    "workers": 0,  # processes to adjust and export prices with, 0 to use none
     "csv_headers": True,
     "csv_delimiter": ",",
 }
 TRADING_SEASSON_END = 16
+# holidays (yyyymmdd) besides weekends and fixed solar holidays, e.g. lunar ones
+TSE_HOLIDAYS: list[int] = []
 
 API_URL = "http://service.tsetmc.com/tsev2/data/TseClient2.aspx"
 
+# http client (shared connection pool used by TSERequest)
+HTTP_POOL = dict(
+    limit=20,  # max open connections
+    limit_per_host=10,  # max open connections to tsetmc
+    ttl_dns_cache=300,  # seconds to keep resolved addresses
+    keepalive_timeout=30,  # seconds to keep idle connections alive
+)
+HTTP_TIMEOUT = 60  # seconds for a whole request
+# seconds a session of TSE trusts its freshness checks
+SESSION_TTL = 60
+
 # Column class
 cols = [
     "date",
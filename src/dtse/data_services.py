@@ -10,15 +10,20 @@ from dtse import config as cfg
 from dtse import tse_utils
 from dtse.cache_manager import TSECache
 from dtse.logger import logger as tse_logger
+from dtse.trading_calendar import TradingCalendar
 from dtse.tse_request import TSERequest
 
 
-def should_update(deven: str, last_possible_deven: str) -> bool:
+def should_update(
+    deven: str, last_possible_deven: str, calendar: TradingCalendar | None = None
+) -> bool:
     """
     Check if the database should be updated
 
     :param deven: str, current date of the cache update
     :param last_possible_deven: str, last possible date of the database
+    :param calendar: TradingCalendar, sessions to count (e.g. TSECache.calendar).
+        default: a calendar of config.TSE_HOLIDAYS
 
     :return: bool, True if the database should be updated, False otherwise
     """
@@ -28,34 +33,58 @@ def should_update(deven: str, last_possible_deven: str) -> bool:
     if deven > last_possible_deven:
         return False
     today = datetime.now()
-    today_str = today.strftime("%Y%m%d")
-    days_passed = abs(
-        (
-            datetime.strptime(last_possible_deven, "%Y%m%d")
-            - datetime.strptime(deven, "%Y%m%d")
-        ).days
+    # wait until the end of trading session
+    session_ended = (
+        today.strftime("%Y%m%d") != last_possible_deven
+        or today.hour > cfg.TRADING_SEASSON_END
     )
-    in_weekend = today.weekday() in [3, 4]
-    last_update_weekday = datetime.strptime(last_possible_deven, "%Y%m%d").weekday()
-    today_is_lpd = today_str == last_possible_deven
-    is_outdated = (
-        days_passed >= cfg.UPDATE_INTERVAL
-        and
-        # wait until the end of trading session
-        ((True, today.hour > cfg.TRADING_SEASSON_END)[today_is_lpd])
-        and
-        # No update needed in weekend if last update was
-        # on last day (wednesday) of THIS week
-        not (in_weekend and last_update_weekday != 3 and days_passed <= 3)
+    # sessions since the last update, weekends and holidays have none
+    calendar = calendar or TradingCalendar(cfg.TSE_HOLIDAYS)
+    sessions = calendar.missing_sessions(int(deven), int(last_possible_deven))
+    return session_ended and len(sessions) >= cfg.UPDATE_INTERVAL
+
+
+def should_update_many(
+    devens: pd.Series,
+    last_possible_deven: str,
+    calendar: TradingCalendar | None = None,
+) -> pd.Series:
+    """
+    Check many dates at once, like should_update. Sessions between the dates
+    and the last possible date are counted in one pass.
+
+    :param devens: pd.Series, dates (int, yyyymmdd) of the cache updates,
+        0 or NA if never updated
+    :param last_possible_deven: str, last possible date of the database
+    :param calendar: TradingCalendar, sessions to count (see should_update)
+
+    :return: pd.Series, True for the dates that should be updated
+    """
+
+    values = pd.to_numeric(devens).astype("float64").fillna(0)
+    never = values == 0
+    if not last_possible_deven:
+        return pd.Series(True, index=devens.index)
+    today = datetime.now()
+    # wait until the end of trading session
+    session_ended = (
+        today.strftime("%Y%m%d") != last_possible_deven
+        or today.hour > cfg.TRADING_SEASSON_END
     )
-    return is_outdated
+    calendar = calendar or TradingCalendar(cfg.TSE_HOLIDAYS)
+    sessions = calendar.count_missing(values, int(last_possible_deven))
+    is_outdated = (sessions >= cfg.UPDATE_INTERVAL) & session_ended
+    return never | is_outdated
 
 
-async def get_last_possible_deven(cached_last_possible_deven: str) -> str:
+async def get_last_possible_deven(
+    cached_last_possible_deven: str, tse_req: TSERequest | None = None
+) -> str:
     """
     Get last possible update date
 
     :param cached_last_possible_deven: str, local value for last possible update date.
+    :param tse_req: TSERequest, client to reuse. a new one is used if not provided.
 
     :return: str, server value for last possible update date
     """
@@ -66,7 +95,7 @@ async def get_last_possible_deven(cached_last_possible_deven: str) -> str:
     )
     if (not cached_last_possible_deven) or should_upd:
         try:
-            req = TSERequest()
+            req = tse_req or TSERequest()
             res = await req.last_possible_deven()
         except Exception as err:
             tse_logger.error(err)
@@ -78,9 +107,14 @@ async def get_last_possible_deven(cached_last_possible_deven: str) -> str:
     return last_possible_deven
 
 
-async def update_instruments(cache: TSECache) -> None:
+async def update_instruments(
+    cache: TSECache, tse_req: TSERequest | None = None
+) -> None:
     """
     Get data about instruments from web service (if needed) and fill cache.instruments
+
+    :param cache: TSECache, cache to update
+    :param tse_req: TSERequest, client to reuse. a new one is used if not provided.
     """
 
     last_update = cache.last_instrument_update
@@ -96,9 +130,13 @@ async def update_instruments(cache: TSECache) -> None:
         last_cached_instrum_date = str(max(cache.instruments["DEven"]))
         if len(cache.splits) > 0:
             last_cached_split_id = max(cache.splits["Idn"])
-    cache.last_possible_deven = await get_last_possible_deven(cache.last_possible_deven)
-    if should_update(last_cached_instrum_date, cache.last_possible_deven):
-        req = TSERequest()
+    cache.last_possible_deven = await get_last_possible_deven(
+        cache.last_possible_deven, tse_req
+    )
+    if should_update(
+        last_cached_instrum_date, cache.last_possible_deven, cache.calendar
+    ):
+        req = tse_req or TSERequest()
         today = datetime.now().strftime("%Y%m%d")
         orig_sym_dict = await req.instruments_and_share(today, last_cached_split_id)
         shares = orig_sym_dict.split("@")[1]
@@ -108,15 +146,18 @@ async def update_instruments(cache: TSECache) -> None:
         elif instruments == "":
             tse_logger.warning("Already updated: Instruments")
         else:
-            converters = {5: tse_utils.clean_fa}
+            fa_col = inst_col_names[5]
             instrums_df = pd.read_csv(
                 StringIO(instruments),
                 names=inst_col_names,
                 lineterminator=line_terminator,
-                converters=converters,
+                dtype={fa_col: str},
                 index_col="InsCode",
             )
-            cache.instruments = instrums_df
+            instrums_df[fa_col] = tse_utils.clean_fa_series(
+                instrums_df[fa_col].fillna("")
+            )
+            cache.merge_instruments(instrums_df)
         if shares == "":
             tse_logger.warning("Already updated: Shares")
         else:
@@ -126,6 +167,6 @@ async def update_instruments(cache: TSECache) -> None:
                 lineterminator=line_terminator,
                 index_col=["InsCode", "DEven"],
             )
-            cache.splits = shares_df
+            cache.merge_splits(shares_df)
         if cache.cache_to_db:
             cache.instruments_to_db()
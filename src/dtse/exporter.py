@@ -0,0 +1,249 @@
+"""
+export prices of many symbols to one file per symbol
+"""
+
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from rich.progress import track
+
+FILE_SUFFIXES = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "parquet": ".parquet",  # needs pyarrow
+    "feather": ".feather",  # needs pyarrow
+}
+_TAIL_BYTES = 1 << 16
+# csv.gz files can not be read from the end, their first and last lines are
+# kept in a sidecar file next to them
+_TAIL_SUFFIX = ".tail"
+
+
+def export_path(directory: Path, name: str, file_format: str = "csv") -> Path:
+    """
+    Path of the exported file of a symbol.
+
+    :directory: Path, export directory
+    :name: str, symbol
+    :file_format: str, one of FILE_SUFFIXES
+
+    :return: Path
+    """
+
+    if file_format not in FILE_SUFFIXES:
+        raise ValueError(f"Unknown file format: {file_format}")
+    # symbols can have dots, so the suffix is added and not replaced
+    return Path(directory) / f"{name}{FILE_SUFFIXES[file_format]}"
+
+
+def _to_csv(data: pd.DataFrame, header: bool = True) -> str:
+    return data.to_csv(header=header, lineterminator="\n")
+
+
+def _tail_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}{_TAIL_SUFFIX}")
+
+
+def _write_tail(path: Path, data: pd.DataFrame) -> None:
+    # keep the header and the last line of a csv.gz file and the file size.
+    # a size that doesn't match the file means the sidecar is stale.
+
+    header = _to_csv(data.iloc[:0]).rstrip("\n")
+    last = _to_csv(data.iloc[-1:], False).rstrip("\n") if len(data) else header
+    tail = {"size": path.stat().st_size, "header": header, "last": last}
+    _tail_path(path).write_text(json.dumps(tail), encoding="utf-8")
+
+
+def _read_tail(path: Path) -> tuple[str, str] | None:
+    # header and last line of a csv.gz file from its sidecar, if still valid
+
+    try:
+        tail = json.loads(_tail_path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if tail.get("size") != path.stat().st_size:
+        return None
+    return tail["header"], tail["last"]
+
+
+def _csv_lines(path: Path, file_format: str) -> tuple[str, str] | None:
+    # first and last line of an exported csv file
+
+    if file_format == "csv.gz":
+        if (lines := _read_tail(path)) is not None:
+            return lines
+        # no valid sidecar, the whole file is read once
+        first = last = None
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as file:
+            for line in file:
+                first = line if first is None else first
+                last = line
+    else:
+        with open(path, "rb") as file:
+            first = file.readline().decode("utf-8")
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - _TAIL_BYTES, 0))
+            lines = file.read().splitlines()
+            last = lines[-1].decode("utf-8") if lines else None
+    if not first or not last:
+        return None
+    return first.rstrip("\r\n"), last.rstrip("\r\n")
+
+
+def _new_rows(data: pd.DataFrame, path: Path, file_format: str) -> pd.DataFrame | None:
+    # rows after the last row of the file or None if the file has to be rewritten.
+    # the last index level of data is the sorted date.
+
+    lines = _csv_lines(path, file_format)
+    dates = data.index.get_level_values(-1)
+    if lines is None or not dates.is_monotonic_increasing:
+        return None
+    header, last = lines
+    if header != _to_csv(data.iloc[:0]).rstrip("\n"):
+        return None
+    if last == header:
+        return data
+    last_date = last.split(",")[data.index.nlevels - 1]
+    stored = np.flatnonzero(dates.astype(str) == last_date)
+    # old rows change when a new dividend or split changes adjusted prices
+    if len(stored) != 1 or _to_csv(data.iloc[stored], False).rstrip("\n") != last:
+        return None
+    return data.iloc[stored[0] + 1 :]
+
+
+def _append(path: Path, text: str, file_format: str) -> None:
+    # append text to a file. the file is cut back to its old size on failure.
+
+    content = text.encode("utf-8")
+    if file_format == "csv.gz":
+        # gzip files can have many members, readers join them
+        content = gzip.compress(content)
+    with open(path, "ab") as file:
+        size = file.tell()
+        try:
+            file.write(content)
+            file.flush()
+        except BaseException:
+            file.truncate(size)
+            raise
+
+
+def _replace(path: Path, data: pd.DataFrame, file_format: str) -> None:
+    # write a complete file to a temporary file and rename it to path
+
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        if file_format == "csv":
+            tmp_path.write_text(_to_csv(data), encoding="utf-8")
+        elif file_format == "csv.gz":
+            tmp_path.write_bytes(gzip.compress(_to_csv(data).encode("utf-8")))
+        elif file_format == "parquet":
+            data.to_parquet(tmp_path)
+        else:
+            # feather files can not store an index
+            data.reset_index().to_feather(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _read_file(path: Path, file_format: str) -> pd.DataFrame:
+    if file_format == "parquet":
+        return pd.read_parquet(path)
+    return pd.read_feather(path)
+
+
+def export_file(data: pd.DataFrame, path: Path, file_format: str = "csv") -> int:
+    """
+    Export prices of a symbol. csv files only get the rows after their last row,
+    other files are replaced if their content changed. csv.gz files have a
+    sidecar file (".tail") with their first and last lines.
+
+    :data: pd.DataFrame, prices indexed by symbol and date
+    :path: Path, path of the file (see export_path)
+    :file_format: str, one of FILE_SUFFIXES
+
+    :return: int, number of written rows
+    """
+
+    if file_format not in FILE_SUFFIXES:
+        raise ValueError(f"Unknown file format: {file_format}")
+    if path.is_file() and file_format in ["csv", "csv.gz"]:
+        new_rows = _new_rows(data, path, file_format)
+        if new_rows is not None:
+            if len(new_rows):
+                _append(path, _to_csv(new_rows, header=False), file_format)
+                if file_format == "csv.gz":
+                    _write_tail(path, data)
+            return len(new_rows)
+    elif path.is_file():
+        old = _read_file(path, file_format)
+        if file_format == "feather":
+            old = old.set_index(data.index.names)
+        if old.equals(data):
+            return 0
+    _replace(path, data, file_format)
+    if file_format == "csv.gz":
+        _write_tail(path, data)
+    return len(data)
+
+
+class PriceExporter:
+    """
+    Export prices of many symbols to one file per symbol on a thread pool.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        file_format: str = "csv",
+        threads: int = 4,
+        progress: bool = False,
+    ):
+        """
+        :directory: Path, export directory. it is created if missing.
+        :file_format: str, one of FILE_SUFFIXES
+        :threads: int, number of threads writing files, 0 writes in this thread
+        :progress: bool, show a progress bar
+        """
+
+        if file_format not in FILE_SUFFIXES:
+            raise ValueError(f"Unknown file format: {file_format}")
+        self.directory = Path(directory)
+        self.file_format = file_format
+        self.threads = threads
+        self.progress = progress
+
+    def _track(self, counts, total: int):
+        if self.progress:
+            return track(counts, total=total, description="Writing data")
+        return counts
+
+    def _export(self, item: tuple) -> int:
+        name, data = item
+        path = export_path(self.directory, name, self.file_format)
+        return export_file(data, path, self.file_format)
+
+    def export(self, prices: dict) -> dict:
+        """
+        Export prices of symbols. empty frames are skipped.
+
+        :prices: dict, prices (pd.DataFrame) of each symbol
+
+        :return: dict, number of written rows of each symbol
+        """
+
+        items = [(name, data) for name, data in prices.items() if len(data)]
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.threads < 2 or len(items) < 2:
+            counts = list(self._track(map(self._export, items), len(items)))
+        else:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                counts = list(self._track(pool.map(self._export, items), len(items)))
+        return {name: count for (name, _), count in zip(items, counts)}
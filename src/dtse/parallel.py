@@ -0,0 +1,298 @@
+"""
+adjust and export prices of many symbols in worker processes
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+from rich.progress import track
+
+from dtse.exporter import PriceExporter
+from dtse.logger import logger as tse_logger
+from dtse.price_adjuster import adjust_prices
+
+# arrays of nullable numbers by the kind of their values
+_MASKED_ARRAYS = {
+    "i": pd.arrays.IntegerArray,
+    "u": pd.arrays.IntegerArray,
+    "f": pd.arrays.FloatingArray,
+    "b": pd.arrays.BooleanArray,
+}
+
+
+class MappedFrame:
+    """
+    Numeric columns of a DataFrame in memory-mapped files.
+    Workers map the columns instead of receiving a pickled copy of the frame.
+    """
+
+    def __init__(self, data: pd.DataFrame, strings: bool = False) -> None:
+        """
+        Write the columns to a temporary directory.
+
+        :data: pd.DataFrame, frame with a default index. non-numeric columns
+            are dropped. nullable numbers (e.g. "Int64") keep missing values.
+        :strings: bool, keep all columns. columns of strings (e.g. symbols) are
+            stored as fixed-width unicode and read back as objects.
+
+        :raises TypeError: if strings is True and a column is neither numeric
+            nor made of strings only, e.g. strings with missing values
+        """
+
+        self._dir = TemporaryDirectory(prefix="dtse-")
+        self.columns = []
+        try:
+            for col in data.columns:
+                self._save(col, data[col], strings)
+        except BaseException:
+            self.close()
+            raise
+
+    def _save(self, col: str, values: pd.Series, strings: bool) -> None:
+        # write a column, and the mask of missing values of nullable numbers
+
+        mask = None
+        if pd.api.types.is_numeric_dtype(values):
+            if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+                mask = values.isna().to_numpy()
+                values = values.to_numpy(dtype=values.dtype.numpy_dtype, na_value=0)
+            else:
+                values = values.to_numpy()
+        elif strings and pd.api.types.infer_dtype(values, skipna=False) in [
+            "string",
+            "empty",
+        ]:
+            values = values.to_numpy(dtype=str)
+        elif strings:
+            raise TypeError(f"Column {col} of {values.dtype} can not be mapped.")
+        else:
+            return
+        np.save(self._file(self._dir.name, col), values)
+        if mask is not None:
+            np.save(self._file(self._dir.name, f"{col}.mask"), mask)
+        self.columns.append(col)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @staticmethod
+    def _file(path: str, col: str) -> Path:
+        return Path(path) / f"{col}.npy"
+
+    @property
+    def spec(self) -> tuple[str, list[str]]:
+        """picklable description of the columns for read()"""
+        return self._dir.name, self.columns
+
+    @classmethod
+    def read(cls, spec: tuple[str, list[str]], rows: np.ndarray | None = None):
+        """
+        Read rows of a mapped frame. only the selected rows are copied.
+
+        :spec: tuple, MappedFrame.spec
+        :rows: np.ndarray, boolean mask or positions of rows to read. None reads
+            all rows.
+
+        :return: pd.DataFrame
+        """
+
+        def _load(file: Path) -> np.ndarray:
+            values = np.load(file, mmap_mode="r")
+            return np.array(values if rows is None else values[rows])
+
+        path, columns = spec
+        data = {}
+        for col in columns:
+            values = _load(cls._file(path, col))
+            mask_file = cls._file(path, f"{col}.mask")
+            if values.dtype.kind == "U":
+                values = values.astype(object)
+            elif mask_file.exists():
+                values = _MASKED_ARRAYS[values.dtype.kind](values, _load(mask_file))
+            data[col] = values
+        return pd.DataFrame(data)
+
+    @classmethod
+    def read_column(cls, spec: tuple[str, list[str]], col: str) -> np.ndarray:
+        """
+        Map a column without copying it.
+
+        :spec: tuple, MappedFrame.spec
+        :col: str, name of the column
+
+        :return: np.ndarray, read-only memory-mapped values
+        """
+
+        return np.load(cls._file(spec[0], col), mmap_mode="r")
+
+    def close(self) -> None:
+        """
+        remove the mapped files
+        """
+
+        self._dir.cleanup()
+
+
+def _executor(workers: int) -> ProcessPoolExecutor:
+    # processes are spawned, forking a process with running threads is not safe
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _shard(groups: pd.Series, sizes: pd.Series, n_shards: int) -> list[pd.Series]:
+    # split sorted groups into n_shards shards with about the same number of rows
+
+    keys = np.sort(groups.unique())
+    rows = sizes.groupby(groups.reindex(sizes.index)).sum().reindex(keys).fillna(0)
+    bounds = np.floor(rows.cumsum().to_numpy() / max(rows.sum(), 1) * n_shards)
+    shard_of_key = pd.Series(np.minimum(bounds, n_shards - 1), index=keys)
+    shard_ids = groups.map(shard_of_key)
+    return [groups[shard_ids == shard] for shard in sorted(shard_ids.unique())]
+
+
+def _read_codes(spec: tuple[str, list[str]], codes: np.ndarray) -> pd.DataFrame:
+    # rows of a mapped frame of codes, indexed by InsCode and DEven
+
+    rows = np.isin(MappedFrame.read_column(spec, "InsCode"), codes)
+    return MappedFrame.read(spec, rows).set_index(["InsCode", "DEven"])
+
+
+def _adjust_shard(
+    spec: tuple[str, list[str]],
+    groups: pd.Series,
+    cond: int,
+    splits_spec: tuple[str, list[str]] | None,
+    nominal_prices: list | None,
+) -> pd.DataFrame:
+    # adjust prices of a shard of groups in a worker
+
+    codes = groups.index.to_numpy()
+    prices = _read_codes(spec, codes)
+    splits = None if splits_spec is None else _read_codes(splits_spec, codes)
+    return adjust_prices(prices, groups, cond, splits, nominal_prices)
+
+
+def adjust_prices_parallel(
+    prices: pd.DataFrame,
+    groups: pd.Series,
+    cond: int,
+    splits: pd.DataFrame | None = None,
+    nominal_prices: list | None = None,
+    workers: int = 2,
+) -> pd.DataFrame:
+    """
+    Adjust closing prices of many instruments in worker processes.
+    Groups are sharded between workers. Result is the same as adjust_prices.
+
+    :prices: pd.DataFrame, prices indexed by InsCode and DEven
+    :groups: pd.Series, group (e.g. symbol) of each InsCode
+    :cond: int, price adjust type. can be 0 (no adjustment), 1, 2 or 3
+    :splits: pd.DataFrame, stock splits indexed by InsCode and DEven
+    :nominal_prices: list, nominal prices of stocks in a new market
+    :workers: int, number of worker processes
+
+    :return: pd.DataFrame, see price_adjuster.adjust_prices
+    """
+
+    groups = groups[groups.notna()]
+    if workers < 2 or groups.nunique() < 2:
+        return adjust_prices(prices, groups, cond, splits, nominal_prices)
+    sizes = prices.index.get_level_values("InsCode").value_counts()
+    shards = _shard(groups, sizes, workers * 2)
+    with ExitStack() as stack:
+        mapped = stack.enter_context(MappedFrame(prices.reset_index()))
+        splits_spec = None
+        if splits is not None:
+            splits_spec = stack.enter_context(MappedFrame(splits.reset_index())).spec
+        pool = stack.enter_context(_executor(workers))
+        futures = [
+            pool.submit(
+                _adjust_shard, mapped.spec, shard, cond, splits_spec, nominal_prices
+            )
+            for shard in shards
+        ]
+        # shards are sorted by group, so the result stays sorted too
+        results = [future.result() for future in futures]
+    return pd.concat(results, ignore_index=True)
+
+
+def _write_shard(
+    spec: tuple[str, list[str]],
+    index_names: list[str],
+    bounds: list[tuple[str, int, int]],
+    directory: Path,
+    file_format: str,
+) -> dict:
+    # export files of a shard of symbols in a worker. bounds are the name and
+    # the first and last (excluded) row of each symbol in the mapped frame.
+
+    rows = np.concatenate([np.arange(start, stop) for _, start, stop in bounds])
+    data = MappedFrame.read(spec, rows).set_index(index_names)
+    prices, offset = {}, 0
+    for name, start, stop in bounds:
+        prices[name] = data.iloc[offset : offset + stop - start]
+        offset += stop - start
+    return PriceExporter(directory, file_format, threads=0).export(prices)
+
+
+def write_files_parallel(
+    prices: dict,
+    directory: Path,
+    file_format: str = "csv",
+    workers: int = 2,
+    progress: bool = False,
+) -> dict:
+    """
+    Export prices of symbols to one file per symbol in worker processes.
+    Prices are passed to workers in a MappedFrame, each worker only reads the
+    rows of its own symbols. Prices with columns a MappedFrame can't keep are
+    exported in this process.
+
+    :prices: dict, prices (pd.DataFrame) of each symbol
+    :directory: Path, directory to write the files to
+    :file_format: str, see exporter.FILE_SUFFIXES
+    :workers: int, number of worker processes
+    :progress: bool, show a progress bar of the written shards
+
+    :return: dict, number of written rows of each symbol
+    """
+
+    items = {name: data for name, data in prices.items() if len(data)}
+    if workers < 2 or len(items) < 2:
+        exporter = PriceExporter(directory, file_format, threads=0, progress=progress)
+        return exporter.export(items)
+    directory.mkdir(parents=True, exist_ok=True)
+    frames = list(items.values())
+    index_names = list(frames[0].index.names)
+    stops = np.cumsum([len(data) for data in frames])
+    bounds = list(zip(items, stops - [len(data) for data in frames], stops))
+    shards = [bounds[i :: workers * 2] for i in range(workers * 2)]
+    try:
+        mapped = MappedFrame(pd.concat(frames).reset_index(), strings=True)
+    except TypeError as err:
+        tse_logger.info("%s Writing data in one process.", err)
+        exporter = PriceExporter(directory, file_format, threads=0, progress=progress)
+        return exporter.export(items)
+    counts = {}
+    with mapped, _executor(workers) as pool:
+        futures = [
+            pool.submit(
+                _write_shard, mapped.spec, index_names, shard, directory, file_format
+            )
+            for shard in shards
+            if shard
+        ]
+        if progress:
+            futures = track(futures, description="Writing data")
+        for future in futures:
+            counts.update(future.result())
+    return counts
@@ -0,0 +1,110 @@
+"""
+adjust daily prices of many instruments at once
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _reverse_cumprod(values: pd.Series, keys: pd.Series) -> pd.Series:
+    # cumulative product from the last row of each group back to its first row
+
+    return values.iloc[::-1].groupby(keys.iloc[::-1], sort=False).cumprod().iloc[::-1]
+
+
+def _fix_nominal_prices(data: pd.DataFrame, key: str, nominal_prices: list) -> None:
+    # find stock moves between markets and replace the nominal price
+    # of the first days in the new market with the last price in the old one.
+    # data has to be sorted by key and date.
+
+    shifted_close = data.groupby(key, sort=False)["PClosing"].shift(1)
+    first_of_code = ~data.duplicated([key, "InsCode"])
+    first_of_group = ~data.duplicated(key)
+    nom_pr = (
+        data["PClosing"].isin(nominal_prices)
+        & first_of_code
+        & ~first_of_group
+        & (shifted_close != data["PriceYesterday"])
+    )
+    if not nom_pr.any():
+        return
+    # a run starts on the first day in the new market
+    # and ends on its first day with trades.
+    code_keys = [data[key], data["InsCode"]]
+    traded = data["QTotTran5J"] != 0
+    trades_before = traded.groupby(code_keys, sort=False).cumsum() - traded
+    moved = nom_pr.groupby(code_keys, sort=False).transform("any")
+    in_run = moved & (trades_before == 0)
+    rep_pr = shifted_close.where(nom_pr).groupby(code_keys, sort=False).ffill()
+    in_run &= rep_pr.notna()
+    # replaced prices are whole, so the columns keep their dtypes
+    for col, rows in [("PClosing", in_run & ~traded), ("PriceYesterday", in_run)]:
+        data.loc[rows, col] = rep_pr[rows].astype(data[col].dtype)
+
+
+def adjust_prices(
+    prices: pd.DataFrame,
+    groups: pd.Series,
+    cond: int,
+    splits: pd.DataFrame | None = None,
+    nominal_prices: list | None = None,
+) -> pd.DataFrame:
+    """
+    Adjust closing prices of many instruments in one pass
+    0: make no adjustments
+    1: adjust according to dividends and splits
+    2: adjust according to splits
+    3: adjust according to cash dividends
+
+    :prices: pd.DataFrame, prices indexed by InsCode and DEven
+    :groups: pd.Series, group (e.g. symbol) of each InsCode. codes of a group
+        are one stock that moved between markets and are adjusted as one series.
+    :cond: int, price adjust type. can be 0 (no adjustment), 1, 2 or 3
+    :splits: pd.DataFrame, stock splits indexed by InsCode and DEven
+    :nominal_prices: list, nominal prices of stocks in a new market
+
+    :return: pd.DataFrame, columns of prices and "AdjPClosing" (if cond is not 0)
+        with a column for the group, InsCode and DEven, sorted by group and date
+    """
+
+    key = groups.name or "Group"
+    price_cols = list(prices.columns)
+    data = prices.reset_index()
+    data.insert(0, key, data["InsCode"].map(groups))
+    data = data[data[key].notna()]
+    data = data.sort_values([key, "DEven", "InsCode"], ignore_index=True)
+    if nominal_prices:
+        _fix_nominal_prices(data, key, nominal_prices)
+    if not cond:
+        return data[[key, "InsCode", "DEven"] + price_cols]
+
+    grp = data.groupby(key, sort=False)
+    if cond in [1, 3]:
+        shifted_yday = grp["PriceYesterday"].shift(-1)
+        data["AdjMultiplr"] = (shifted_yday / data["PClosing"]).fillna(1)
+    if cond in [2, 3]:
+        data["SplitMultiplr"] = 1.0
+        if splits is not None and not splits.empty:
+            split_multiplr = (
+                splits["NumberOfShareOld"] / splits["NumberOfShareNew"]
+            ).rename("SplitMultiplr")
+            data = data.drop(columns="SplitMultiplr").join(
+                split_multiplr, on=["InsCode", "DEven"]
+            )
+            data["SplitMultiplr"] = data["SplitMultiplr"].fillna(1)
+            grp = data.groupby(key, sort=False)
+    if cond == 1:
+        multiplr = _reverse_cumprod(data["AdjMultiplr"], data[key])
+    elif cond == 2:
+        multiplr = _reverse_cumprod(data["SplitMultiplr"], data[key])
+        multiplr = multiplr.groupby(data[key], sort=False).shift(-1).fillna(1)
+    elif cond == 3:
+        next_split = grp["SplitMultiplr"].shift(-1)
+        divid_multiplr = data["AdjMultiplr"].where(next_split.isin([1]), 1)
+        multiplr = _reverse_cumprod(divid_multiplr, data[key])
+    else:
+        raise ValueError(f"Invalid adjust type: {cond}")
+    adjusted = np.round(multiplr * data["PClosing"])
+    # missing closing prices stay missing
+    data["AdjPClosing"] = adjusted.astype("Int64" if adjusted.isna().any() else "int64")
+    return data[[key, "InsCode", "DEven"] + price_cols + ["AdjPClosing"]]
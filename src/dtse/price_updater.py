@@ -4,15 +4,129 @@ update prices for selected symbols
 
 import asyncio
 import re
-from io import StringIO
+from contextlib import asynccontextmanager
 
+import numpy as np
 import pandas as pd
-from aiohttp import ClientResponseError
+from aiohttp import ClientError
 
 from dtse import config as cfg
 from dtse.cache_manager import TSECache
 from dtse.logger import logger as tse_logger
 from dtse.tse_request import TSERequest
+from dtse.tse_utils import parse_closing_prices
+
+
+class AdaptiveLimiter:
+    """
+    Bound in-flight requests and space out their start times.
+
+    The bound grows additively while responses are fast and successful, and
+    shrinks multiplicatively on errors or slow responses (AIMD), at most once
+    per window of requests.
+    Settings that are not given are read from the config when it is created.
+    """
+
+    def __init__(
+        self,
+        initial: int | None = None,
+        minimum: int | None = None,
+        maximum: int | None = None,
+        target_latency: float | None = None,
+        min_interval: float | None = None,
+        backoff_factor: float | None = None,
+    ) -> None:
+        """
+        Initialize the limiter.
+
+        :initial: int, initial number of allowed in-flight requests
+            (default: config.PRICES_UPDATE_CONCURRENCY)
+        :minimum: int, lower bound for the limit
+            (default: config.PRICES_UPDATE_MIN_CONCURRENCY)
+        :maximum: int, upper bound for the limit
+            (default: config.PRICES_UPDATE_MAX_CONCURRENCY)
+        :target_latency: float, seconds. slower responses count as congestion
+            (default: config.PRICES_UPDATE_TARGET_LATENCY)
+        :min_interval: float, min seconds between two request starts
+            (default: config.PRICES_UPDATE_CHUNK_DELAY)
+        :backoff_factor: float, multiply the limit by this on congestion
+            (default: config.PRICES_UPDATE_BACKOFF_FACTOR)
+        """
+
+        def _or_cfg(value, name):
+            return getattr(cfg, name) if value is None else value
+
+        self.minimum = _or_cfg(minimum, "PRICES_UPDATE_MIN_CONCURRENCY")
+        self.maximum = _or_cfg(maximum, "PRICES_UPDATE_MAX_CONCURRENCY")
+        initial = _or_cfg(initial, "PRICES_UPDATE_CONCURRENCY")
+        self.limit: float = min(max(initial, self.minimum), self.maximum)
+        self.target_latency = _or_cfg(target_latency, "PRICES_UPDATE_TARGET_LATENCY")
+        self.min_interval = _or_cfg(min_interval, "PRICES_UPDATE_CHUNK_DELAY")
+        self.backoff_factor = _or_cfg(backoff_factor, "PRICES_UPDATE_BACKOFF_FACTOR")
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+        self._next_start = 0.0
+        # number of back offs, requests started before the last one are
+        # of an old window
+        self._window = 0
+
+    async def acquire(self) -> int:
+        """
+        wait for a free slot and for the rate budget
+
+        :return: int, window of the request, to pass to release
+        """
+
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            now = loop.time()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self.min_interval
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+        return self._window
+
+    async def release(
+        self, latency: float, failed: bool = False, window: int | None = None
+    ) -> None:
+        """
+        free a slot and adapt the limit to the result of the request
+
+        :latency: float, seconds the request took
+        :failed: bool, True if the request failed
+        :window: int, window of the request (see acquire). congestion of a
+            request started before the last back off doesn't shrink the limit
+            again. None counts the request in the current window.
+        """
+
+        async with self._cond:
+            self.in_flight -= 1
+            if failed or latency > self.target_latency:
+                if window is None or window == self._window:
+                    self.limit = max(self.minimum, self.limit * self.backoff_factor)
+                    self._window += 1
+            else:
+                # about one more slot after a full window of successes
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        hold a slot while running the body and report its latency
+        """
+
+        window = await self.acquire()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            await self.release(loop.time() - start, failed, window)
 
 
 class PriceUpdater:
@@ -20,14 +134,30 @@ class PriceUpdater:
     update prices for selected symbols
     """
 
-    def __init__(self, cache: TSECache) -> None:
+    def __init__(
+        self,
+        cache: TSECache,
+        tse_req: TSERequest | None = None,
+        limiter: dict | None = None,
+    ) -> None:
         """
         Initialize the class.
+
+        :cache: TSECache, cache to add downloaded prices to
+        :tse_req: TSERequest, client to reuse. a new one is used if not provided.
+        :limiter: dict, settings of the AdaptiveLimiter of the requests, e.g.
+            {"min_interval": 1}. default: "price_requests" of the cache settings
         """
 
         self.succs: list = []
         self.fails: list = []
         self._cache: TSECache = cache
+        self._tse_req: TSERequest = tse_req or TSERequest()
+        if limiter is None:
+            limiter = cache.settings.get("price_requests")
+        self._limiter = AdaptiveLimiter(**(limiter or {}))
+        # journal rows of the codes to update, see TSECache.price_jobs
+        self._jobs: pd.DataFrame | None = None
 
     async def _on_result(self, response, chunk):
         """
@@ -37,28 +167,98 @@ class PriceUpdater:
         ins_codes = chunk.index
         pattern = re.compile(r"^[\d.,;@-]+$")
         if isinstance(response, str) and (pattern.search(response) or response == ""):
-            resp_list = response.split("@")
-            if len(ins_codes) != len(resp_list):
-                raise ValueError(
-                    f"requested {len(ins_codes)} codes, got {len(resp_list)}"
-                )
-            col_names = cfg.tse_closing_prices_info
-            line_terminator = cfg.RESP_LN_TERMINATOR
-            new_prc_df_list = [
-                pd.read_csv(
-                    StringIO(resp),
-                    names=col_names,
-                    lineterminator=line_terminator,
-                    index_col=["InsCode", "DEven"],
-                )
-                for resp in resp_list
-                if resp
-            ]
+            new_prices = parse_closing_prices(response, len(ins_codes))
             self.succs.extend(ins_codes)
-            self._cache.update_last_devens(self.succs)
-            self._cache.add_to_prices(new_prc_df_list)
+            self._cache.update_last_devens(list(ins_codes), new_prices)
+            self._cache.add_to_prices([new_prices])
+            self._set_jobs(chunk, cfg.JOB_DONE, new_prices)
         else:
             self.fails.extend(ins_codes)
+            self._set_jobs(chunk, cfg.JOB_FAILED)
+
+    def _set_jobs(
+        self,
+        chunk: pd.DataFrame,
+        status: str,
+        new_prices: pd.DataFrame | None = None,
+        persist: bool = True,
+    ) -> None:
+        # record the status of the codes of a chunk in the journal.
+        # done jobs continue from the last downloaded date.
+
+        jobs = self._jobs.loc[chunk.index].assign(Status=status)
+        if new_prices is not None and not new_prices.empty:
+            last_devens = (
+                new_prices.index.to_frame(index=False).groupby("InsCode")["DEven"].max()
+            )
+            jobs["DEven"] = np.maximum(
+                jobs["DEven"], last_devens.reindex(jobs.index).fillna(0)
+            ).astype("int64")
+        if persist:
+            self._cache.set_price_jobs(jobs)
+        self._jobs.loc[jobs.index] = jobs
+
+    def _start_jobs(self, outdated_insts: pd.DataFrame) -> pd.DataFrame:
+        # add unfinished jobs of an interrupted update to outdated codes, split
+        # them into chunks and record them as pending in the journal.
+        # jobs that were started too many times are dropped instead of resumed.
+
+        jobs = self._cache.price_jobs
+        unfinished = jobs[~jobs["Status"].isin([cfg.JOB_DONE, cfg.JOB_DROPPED])].astype(
+            {"Attempts": "int64"}
+        )
+        not_requested = ~unfinished.index.isin(outdated_insts.index)
+        given_up = not_requested & (
+            unfinished["Attempts"] >= cfg.PRICES_UPDATE_MAX_ATTEMPTS
+        )
+        if given_up.any():
+            tse_logger.warning(
+                "Dropping unfinished downloads of %s codes after %s attempts: %s",
+                given_up.sum(),
+                cfg.PRICES_UPDATE_MAX_ATTEMPTS,
+                ", ".join(map(str, unfinished.index[given_up])),
+            )
+            self._cache.set_price_jobs(
+                unfinished[given_up].assign(Status=cfg.JOB_DROPPED)
+            )
+        resumed = unfinished.loc[not_requested & ~given_up, ["DEven", "NotInNoMarket"]]
+        if not resumed.empty:
+            tse_logger.info("Resuming an interrupted update of %s codes.", len(resumed))
+            outdated_insts = pd.concat([resumed, outdated_insts])
+        # continue with the codes where the last update stopped
+        first = outdated_insts.index.isin(unfinished.index)
+        outdated = outdated_insts.iloc[np.argsort(~first, kind="stable")]
+        outdated = outdated.astype("int64")
+        # codes without sessions after their last downloaded date are checked
+        # and done without a request
+        current = self._is_current(outdated["DEven"])
+        if current.any():
+            tse_logger.info("No new sessions for %s codes.", current.sum())
+            self._cache.update_last_devens(list(outdated.index[current]))
+            # stores last_devens of the codes
+            self._cache.add_to_prices([])
+        chunks = np.full(len(outdated), -1)
+        chunks[~current] = np.arange((~current).sum()) // cfg.PRICES_UPDATE_CHUNK
+        attempts = unfinished["Attempts"].reindex(outdated.index, fill_value=0) + 1
+        self._jobs = outdated.assign(
+            Chunk=chunks,
+            Status=np.where(current, cfg.JOB_DONE, cfg.JOB_PENDING),
+            Attempts=attempts,
+        )[cfg.price_jobs_info[1:]]
+        self._cache.set_price_jobs(self._jobs)
+        return outdated[~current]
+
+    def _is_current(self, devens: pd.Series) -> np.ndarray:
+        # True for the codes with no session after their last downloaded date
+
+        until = self._cache.last_possible_deven
+        if not until:
+            return np.zeros(len(devens), dtype=bool)
+        calendar = self._cache.calendar
+        # the server has prices of the last possible date
+        calendar.add_sessions([int(until)])
+        missing = calendar.count_missing(devens, int(until))
+        return ((missing == 0) & (devens > 0)).to_numpy()
 
     async def _request(self, chunk) -> None:
         """
@@ -72,30 +272,39 @@ class PriceUpdater:
         # remove last "lineterminator" from the string
         req_param = req_param[:-1]
 
-        while retries:
-            try:
-                tse_req = TSERequest()
-                res = await tse_req.closing_prices(req_param)
-                retries = 0
-            except ClientResponseError:
-                retries -= 1
-                if retries:
-                    await asyncio.sleep(back_off)
-                    tse_logger.warning(
-                        "No responce for codes: %s. Try %d of %d.",
-                        ", ".join(chunk.index.to_list()),
-                        cfg.PRICES_UPDATE_RETRY_COUNT - retries,
-                        cfg.PRICES_UPDATE_RETRY_COUNT,
-                    )
-                    # Double the waiting time after each retry
-                    back_off = back_off * 2
-                else:
-                    res = "error"
-        await self._on_result(res, chunk)
+        try:
+            while retries:
+                try:
+                    async with self._limiter.slot():
+                        # only kept in memory, the journal is written when done
+                        self._set_jobs(chunk, cfg.JOB_IN_FLIGHT, persist=False)
+                        res = await self._tse_req.closing_prices(req_param)
+                    retries = 0
+                # error responses and lost connections, e.g. a pooled
+                # connection closed by the server
+                except (ClientError, asyncio.TimeoutError):
+                    retries -= 1
+                    if retries:
+                        await asyncio.sleep(back_off)
+                        tse_logger.warning(
+                            "No responce for codes: %s. Try %d of %d.",
+                            ", ".join(map(str, chunk.index)),
+                            cfg.PRICES_UPDATE_RETRY_COUNT - retries,
+                            cfg.PRICES_UPDATE_RETRY_COUNT,
+                        )
+                        # Double the waiting time after each retry
+                        back_off = back_off * 2
+                    else:
+                        res = "error"
+            await self._on_result(res, chunk)
+        finally:
+            # a request or its processing raised, the chunk is not done
+            if (self._jobs.loc[chunk.index, "Status"] == cfg.JOB_IN_FLIGHT).any():
+                self._set_jobs(chunk, cfg.JOB_FAILED)
 
     async def _batch(self, chunks: list):
         """
-        gather requests
+        gather requests. the limiter decides how many of them are in flight.
         """
 
         await asyncio.gather(*[self._request(chunk) for chunk in chunks])
@@ -108,11 +317,16 @@ class PriceUpdater:
         """
 
         tse_logger.info("Getting ready to download prices.")
+        outdated_insts = self._start_jobs(outdated_insts)
         # Yield successive evenly sized chunks from 'outdated_insts'.
         n_rows = cfg.PRICES_UPDATE_CHUNK
         chunks = [
             outdated_insts[i : i + n_rows]
             for i in range(0, len(outdated_insts), n_rows)
         ]
-        await self._batch(chunks)
+        if self._tse_req.is_open:
+            await self._batch(chunks)
+        else:
+            async with self._tse_req:
+                await self._batch(chunks)
         return {"succs": self.succs, "fails": self.fails}
@@ -0,0 +1,547 @@
+"""
+storage backends for cached data
+"""
+
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import pandas as pd
+
+# fmt: off
+from sqlalchemy import (BigInteger, Column, Engine, Float, Integer, MetaData,
+                        Table, event, inspect, select)
+# fmt: on
+
+from sqlalchemy.dialects.sqlite import insert
+
+from dtse import config as cfg
+from dtse.logger import logger as tse_logger
+from dtse.tse_utils import to_prices_dtypes
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from pyarrow import fs
+except ImportError:  # optional dependency, only needed for ParquetStorage
+    pa = None
+
+
+class StorageBackend(ABC):
+    """
+    Interface of the places TSECache persists its data to
+    """
+
+    @abstractmethod
+    def read_table(self, table_name: str, index_col: list[str]) -> pd.DataFrame | None:
+        """
+        Read a whole table.
+
+        :table_name: str, name of the table
+        :index_col: list[str], columns to use as index
+
+        :return: pd.DataFrame or None if the table does not exist
+        """
+
+    @abstractmethod
+    def write_table(
+        self, table_name: str, data: pd.DataFrame, index_label: str | list[str]
+    ) -> None:
+        """
+        Replace a whole table with data.
+
+        :table_name: str, name of the table
+        :data: pd.DataFrame, new content of the table
+        :index_label: str or list[str], names of the index columns
+        """
+
+    @abstractmethod
+    def upsert_table(
+        self, table_name: str, data: pd.DataFrame, index_label: str | list[str]
+    ) -> None:
+        """
+        Insert rows of data into a table, replacing all rows with the same index.
+
+        :table_name: str, name of the table
+        :data: pd.DataFrame, new and changed rows
+        :index_label: str or list[str], names of the index columns (the key)
+        """
+
+    @abstractmethod
+    def read_prices(
+        self,
+        codes: list[int],
+        start_date: int,
+        end_date: int | None = None,
+        columns: list[str] | None = None,
+    ) -> pd.DataFrame | None:
+        """
+        Read daily prices of instruments, with compact dtypes (see to_prices_dtypes)
+
+        :codes: list[int], instrument codes to read
+        :start_date: int, first date to read (yyyymmdd)
+        :end_date: int, last date to read (yyyymmdd). None reads up to the last date.
+        :columns: list[str], price columns to read. None reads all of them.
+
+        :return: pd.DataFrame indexed by InsCode and DEven or None if there is no data
+        """
+
+    @abstractmethod
+    def write_prices(self, new_prcs: pd.DataFrame) -> None:
+        """
+        Insert new daily prices. Existing rows with the same code and date are replaced.
+
+        :new_prcs: pd.DataFrame, prices indexed by InsCode and DEven
+        """
+
+    @abstractmethod
+    def write_last_devens(self, last_devens: pd.DataFrame) -> None:
+        """
+        Insert or update the last downloaded and the last checked date of
+        instruments.
+
+        :last_devens: pd.DataFrame, "LastDEven" and "LastChecked" columns
+            indexed by InsCode
+        """
+
+    @abstractmethod
+    def read_adjusted(self, cond: int, key: str) -> tuple[str, pd.DataFrame] | None:
+        """
+        Read stored adjusted prices.
+
+        :cond: int, price adjust type
+        :key: str, codes of the adjusted series
+
+        :return: tuple of version and adjusted prices, sorted by date, or None
+            if not stored
+        """
+
+    @abstractmethod
+    def write_adjusted(
+        self, cond: int, key: str, version: str, data: pd.DataFrame
+    ) -> None:
+        """
+        Store adjusted prices, replacing older versions.
+
+        :cond: int, price adjust type
+        :key: str, codes of the adjusted series
+        :version: str, version of the prices and splits data was adjusted with
+        :data: pd.DataFrame, adjusted prices
+        """
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Store data in a SQLite database
+    """
+
+    def __init__(self, engine: Engine, pragmas: dict | None = None) -> None:
+        """
+        Initialize the database.
+
+        :engine: Engine, engine of the sqlite database
+        :pragmas: dict, pragmas to run on each new connection
+        """
+
+        self._engine = engine
+        self._set_pragmas(cfg.storage["SQLITE_PRAGMAS"] if pragmas is None else pragmas)
+        # tables are created and inspected on first use, then the results are kept
+        self._table_names: set[str] | None = None
+        self._prices_table: Table | None = None
+
+    def _has_table(self, table_name: str) -> bool:
+        # check if a table exists, inspecting the database only once
+
+        if self._table_names is None:
+            self._table_names = set(inspect(self._engine).get_table_names())
+        return table_name in self._table_names
+
+    def _add_table(self, table_name: str):
+        # remember a table created by this storage
+
+        if self._table_names is not None:
+            self._table_names.add(table_name)
+
+    def _init_db(self) -> Table:
+        # create or migrate the tables of prices on first use and
+        # return the reflected "daily_prices" table.
+
+        if self._prices_table is None:
+            last_deven_sql = Table(
+                "last_devens",
+                MetaData(),
+                Column("InsCode", BigInteger, primary_key=True),
+                Column("LastDEven", Integer),
+                Column("LastChecked", Integer),
+            )
+            last_deven_sql.create(checkfirst=True, bind=self._engine)
+            self._add_table("last_devens")
+            self._migrate_last_devens(last_deven_sql)
+            self._init_prices_table()
+            self._index_splits()
+            self._prices_table = Table(
+                "daily_prices", MetaData(), autoload_with=self._engine
+            )
+        return self._prices_table
+
+    def _migrate_last_devens(self, last_deven_sql: Table):
+        # older versions stored the date of the last check as "LastDEven",
+        # some without a primary key.
+
+        t_name = "last_devens"
+        inspector = inspect(self._engine)
+        old_cols = [col["name"] for col in inspector.get_columns(t_name)]
+        has_pk = inspector.get_pk_constraint(t_name)["constrained_columns"]
+        if "LastChecked" in old_cols and has_pk:
+            return
+        checked = "LastChecked" if "LastChecked" in old_cols else "LastDEven"
+        with self._engine.begin() as conn:
+            conn.exec_driver_sql(f"ALTER TABLE {t_name} RENAME TO {t_name}_old")
+            last_deven_sql.create(bind=conn)
+            conn.exec_driver_sql(
+                f"INSERT OR REPLACE INTO {t_name} (InsCode, LastDEven, LastChecked) "
+                f"SELECT InsCode, LastDEven, {checked} FROM {t_name}_old"
+            )
+            conn.exec_driver_sql(f"DROP TABLE {t_name}_old")
+
+    def _set_pragmas(self, pragmas: dict):
+        # apply the sqlite performance profile to each new connection.
+
+        @event.listens_for(self._engine, "connect")
+        def set_sqlite_pragmas(dbapi_conn, _):
+            cursor = dbapi_conn.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    def _index_splits(self):
+        # covering index for reading splits by code and date
+
+        if self._has_table("splits"):
+            with self._engine.begin() as conn:
+                conn.exec_driver_sql(
+                    "CREATE INDEX IF NOT EXISTS ix_splits_InsCode_DEven ON splits "
+                    "(InsCode, DEven, NumberOfShareOld, NumberOfShareNew)"
+                )
+
+    def _init_prices_table(self):
+        # create "daily_prices" keyed by (InsCode, DEven) and migrate old tables.
+        # without rowid, rows are stored in key order, so the primary key is a
+        # covering index for reads by code and date range.
+
+        t_name = "daily_prices"
+        int_cols = ["ZTotTran", "QTotTran5J"]
+        prcs_table = Table(
+            t_name,
+            MetaData(),
+            Column("InsCode", BigInteger, primary_key=True),
+            Column("DEven", Integer, primary_key=True),
+            *[
+                Column(col, BigInteger if col in int_cols else Float)
+                for col in cfg.tse_closing_prices_info[2:]
+            ],
+            sqlite_with_rowid=False,
+        )
+        inspector = inspect(self._engine)
+        if not self._has_table(t_name):
+            prcs_table.create(bind=self._engine)
+            self._add_table(t_name)
+        elif not inspector.get_pk_constraint(t_name)["constrained_columns"]:
+            # tables written by older versions have no primary key
+            tse_logger.info("Removing duplicate rows from the price database.")
+            old_name = f"{t_name}_old"
+            old_cols = [col["name"] for col in inspector.get_columns(t_name)]
+            cols = ", ".join(c.name for c in prcs_table.c if c.name in old_cols)
+            with self._engine.begin() as conn:
+                conn.exec_driver_sql(f"ALTER TABLE {t_name} RENAME TO {old_name}")
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS ix_{t_name}_InsCode")
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS ix_{t_name}_DEven")
+                prcs_table.create(bind=conn)
+                conn.exec_driver_sql(
+                    f"INSERT OR REPLACE INTO {t_name} ({cols}) "
+                    f"SELECT {cols} FROM {old_name}"
+                )
+                conn.exec_driver_sql(f"DROP TABLE {old_name}")
+
+    def read_table(self, table_name: str, index_col: list[str]) -> pd.DataFrame | None:
+        if self._has_table(table_name):
+            with self._engine.connect() as conn:
+                data = pd.read_sql_table(
+                    table_name=table_name, con=conn, index_col=index_col
+                )
+            return data
+        return None
+
+    def write_table(
+        self, table_name: str, data: pd.DataFrame, index_label: str | list[str]
+    ) -> None:
+        with self._engine.connect() as conn:
+            data.to_sql(
+                name=table_name,
+                con=conn,
+                if_exists="replace",
+                index=True,
+                method="multi",
+                index_label=index_label,
+            )
+        self._add_table(table_name)
+        if table_name == "splits":
+            self._index_splits()
+
+    def upsert_table(
+        self, table_name: str, data: pd.DataFrame, index_label: str | list[str]
+    ) -> None:
+        if not self._has_table(table_name):
+            self.write_table(table_name, data, index_label=index_label)
+            return
+        keys = [index_label] if isinstance(index_label, str) else list(index_label)
+        key_cols = ", ".join(f'"{col}"' for col in keys)
+        cols = ", ".join(f'"{col}"' for col in [*keys, *data.columns])
+        tmp_name = f"{table_name}_upsert"
+        # stage the rows, then replace the rows with the same key in one transaction
+        with self._engine.begin() as conn:
+            data.to_sql(tmp_name, conn, if_exists="replace", index_label=keys)
+            conn.exec_driver_sql(
+                f"DELETE FROM {table_name} WHERE ({key_cols}) IN "
+                f"(SELECT {key_cols} FROM {tmp_name})"
+            )
+            conn.exec_driver_sql(
+                f"INSERT INTO {table_name} ({cols}) SELECT {cols} FROM {tmp_name}"
+            )
+            conn.exec_driver_sql(f"DROP TABLE {tmp_name}")
+
+    def read_prices(
+        self,
+        codes: list[int],
+        start_date: int,
+        end_date: int | None = None,
+        columns: list[str] | None = None,
+    ) -> pd.DataFrame | None:
+        prcs_table = self._init_db()
+        if columns is None:
+            columns = [col.name for col in prcs_table.c][2:]
+        cols = ["InsCode", "DEven", *columns]
+        cond = prcs_table.c.InsCode.in_(codes) & (prcs_table.c.DEven >= start_date)
+        if end_date is not None:
+            cond &= prcs_table.c.DEven <= end_date
+        qry = select(*[prcs_table.c[col] for col in cols]).where(cond)
+        with self._engine.connect() as conn:
+            data = pd.read_sql_query(qry, conn)
+        return to_prices_dtypes(data).set_index(["InsCode", "DEven"])
+
+    def write_prices(self, new_prcs: pd.DataFrame) -> None:
+        t_name = "daily_prices"
+        keys = ["InsCode", "DEven"]
+        cols = [c for c in cfg.tse_closing_prices_info[2:] if c in new_prcs]
+        data = new_prcs.reset_index()[keys + cols]
+        # plain python rows for the driver's executemany
+        rows = list(zip(*(data[col].tolist() for col in data.columns)))
+        on_conflict = "DO NOTHING"
+        if cols:
+            on_conflict = "DO UPDATE SET " + ", ".join(
+                f"{col} = excluded.{col}" for col in cols
+            )
+        self._init_db()
+        upsert_sql = (
+            f"INSERT INTO {t_name} ({', '.join(data.columns)}) "
+            f"VALUES ({', '.join('?' * len(data.columns))}) "
+            f"ON CONFLICT ({', '.join(keys)}) {on_conflict}"
+        )
+        with self._engine.begin() as conn:
+            conn.exec_driver_sql(upsert_sql, rows)
+
+    def write_last_devens(self, last_devens: pd.DataFrame) -> None:
+        def sqlite_upsert(table, conn, keys, data_iter):
+            """
+            update columns on primary key conflict
+            """
+            data = [dict(zip(keys, row)) for row in data_iter]
+            insert_stmt = insert(table.table).values(data)
+            upsert_stmt = insert_stmt.on_conflict_do_update(
+                index_elements=table.index,
+                set_={
+                    c.name: c for c in insert_stmt.excluded if not c.name in table.index
+                },
+            )
+            result = conn.execute(upsert_stmt)
+            return result.rowcount
+
+        self._init_db()
+        with self._engine.connect() as conn:
+            last_devens.to_sql(
+                name="last_devens",
+                con=conn,
+                if_exists="append",
+                method=sqlite_upsert,
+                chunksize=4000,
+                index_label=["InsCode"],
+            )
+
+    def read_adjusted(self, cond: int, key: str) -> tuple[str, pd.DataFrame] | None:
+        t_name = f"adjusted_prices_{cond}"
+        if not self._has_table(t_name):
+            return None
+        with self._engine.connect() as conn:
+            # rows of a series are sorted by date, like adjust_prices returns them
+            data = pd.read_sql_query(
+                f"SELECT * FROM {t_name} WHERE CacheKey = ? "
+                'ORDER BY "DEven", "InsCode"',
+                conn,
+                params=(key,),
+            )
+        if data.empty:
+            return None
+        version = data["Version"].iloc[0]
+        return version, data.drop(columns=["CacheKey", "Version"])
+
+    def write_adjusted(
+        self, cond: int, key: str, version: str, data: pd.DataFrame
+    ) -> None:
+        t_name = f"adjusted_prices_{cond}"
+        data = data.assign(CacheKey=key, Version=version)
+        with self._engine.begin() as conn:
+            if self._has_table(t_name):
+                conn.exec_driver_sql(f"DELETE FROM {t_name} WHERE CacheKey = ?", (key,))
+            data.to_sql(t_name, conn, if_exists="append", index=False, chunksize=5000)
+            conn.exec_driver_sql(
+                f"CREATE INDEX IF NOT EXISTS ix_{t_name}_CacheKey "
+                f"ON {t_name} (CacheKey)"
+            )
+        self._add_table(t_name)
+
+
+class ParquetStorage(StorageBackend):
+    """
+    Store data in parquet files. needs "pyarrow".
+
+    Prices are partitioned by instrument ("daily_prices/InsCode=<code>/"), so
+    reading a few instruments only opens their files. Files are memory-mapped.
+    """
+
+    _prices_dir = "daily_prices"
+
+    def __init__(self, data_dir: Path) -> None:
+        """
+        Initialize the storage.
+
+        :data_dir: Path, directory to keep the parquet files in
+        """
+
+        if pa is None:
+            raise ImportError(
+                'parquet storage needs "pyarrow". install it with: '
+                "pip install dtse[parquet]"
+            )
+        self._data_dir = Path(data_dir)
+        self._fs = fs.LocalFileSystem(use_mmap=True)
+        self._partitioning = ds.partitioning(
+            pa.schema([("InsCode", pa.int64())]), flavor="hive"
+        )
+
+    def _table_path(self, table_name: str) -> Path:
+        return self._data_dir / f"{table_name}.parquet"
+
+    def _prices_path(self, code: int) -> Path:
+        return self._data_dir / self._prices_dir / f"InsCode={code}" / "part-0.parquet"
+
+    @staticmethod
+    def _replace_file(path: Path, table) -> None:
+        # write to a temp file and move it over the old one
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def read_table(self, table_name: str, index_col: list[str]) -> pd.DataFrame | None:
+        path = self._table_path(table_name)
+        if not path.is_file():
+            return None
+        data = pq.read_table(path, memory_map=True).to_pandas()
+        if list(data.index.names) != list(index_col):
+            data = data.reset_index(drop=data.index.names == [None]).set_index(
+                index_col
+            )
+        return data
+
+    def write_table(
+        self, table_name: str, data: pd.DataFrame, index_label: str | list[str]
+    ) -> None:
+        data = data.rename_axis(index_label)
+        self._replace_file(
+            self._table_path(table_name),
+            pa.Table.from_pandas(data, preserve_index=True),
+        )
+
+    def upsert_table(
+        self, table_name: str, data: pd.DataFrame, index_label: str | list[str]
+    ) -> None:
+        keys = [index_label] if isinstance(index_label, str) else list(index_label)
+        old = self.read_table(table_name, index_col=keys)
+        data = data.rename_axis(keys)
+        if old is not None:
+            data = pd.concat([old[~old.index.isin(data.index)], data])
+        self.write_table(table_name, data, index_label=keys)
+
+    def read_prices(
+        self,
+        codes: list[int],
+        start_date: int,
+        end_date: int | None = None,
+        columns: list[str] | None = None,
+    ) -> pd.DataFrame | None:
+        files = [str(path) for path in map(self._prices_path, codes) if path.is_file()]
+        if not files:
+            return None
+        dataset = ds.dataset(
+            files,
+            format="parquet",
+            partitioning=self._partitioning,
+            partition_base_dir=str(self._data_dir / self._prices_dir),
+            filesystem=self._fs,
+        )
+        cond = ds.field("DEven") >= start_date
+        if end_date is not None:
+            cond &= ds.field("DEven") <= end_date
+        if columns is not None:
+            columns = ["InsCode", "DEven", *columns]
+        table = dataset.to_table(columns=columns, filter=cond)
+        data = to_prices_dtypes(table.to_pandas())
+        return data.set_index(["InsCode", "DEven"]).sort_index()
+
+    def write_prices(self, new_prcs: pd.DataFrame) -> None:
+        cols = [c for c in cfg.tse_closing_prices_info[2:] if c in new_prcs]
+        for code, new_rows in new_prcs[cols].groupby(level="InsCode"):
+            new_rows = new_rows.droplevel("InsCode")
+            path = self._prices_path(code)
+            if path.is_file():
+                old_rows = pq.read_table(path, memory_map=True).to_pandas()
+                new_rows = pd.concat([old_rows.set_index("DEven"), new_rows])
+                new_rows = new_rows[~new_rows.index.duplicated(keep="last")]
+            table = pa.Table.from_pandas(
+                new_rows.sort_index().reset_index(), preserve_index=False
+            )
+            self._replace_file(path, table)
+
+    def write_last_devens(self, last_devens: pd.DataFrame) -> None:
+        old = self.read_table("last_devens", index_col=["InsCode"])
+        if old is not None:
+            last_devens = pd.concat([old, last_devens])
+            last_devens = last_devens[~last_devens.index.duplicated(keep="last")]
+        self.write_table("last_devens", last_devens, index_label="InsCode")
+
+    def _adjusted_path(self, cond: int, key: str) -> Path:
+        return self._data_dir / f"adjusted_prices_{cond}" / f"{key}.parquet"
+
+    def read_adjusted(self, cond: int, key: str) -> tuple[str, pd.DataFrame] | None:
+        path = self._adjusted_path(cond, key)
+        if not path.is_file():
+            return None
+        data = pq.read_table(path, memory_map=True).to_pandas()
+        return data["Version"].iloc[0], data.drop(columns="Version")
+
+    def write_adjusted(
+        self, cond: int, key: str, version: str, data: pd.DataFrame
+    ) -> None:
+        table = pa.Table.from_pandas(data.assign(Version=version), preserve_index=False)
+        self._replace_file(self._adjusted_path(cond, key), table)
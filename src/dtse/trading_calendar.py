@@ -0,0 +1,118 @@
+"""
+trading sessions of the Tehran stock exchange
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from jdatetime import date as jdate
+
+# Thursday and Friday
+WEEKEND = [3, 4]
+# official holidays on fixed days of the solar (jalali) year as (month, day)
+JALALI_HOLIDAYS = [
+    (1, 1),
+    (1, 2),
+    (1, 3),
+    (1, 4),
+    (1, 12),
+    (1, 13),
+    (3, 14),
+    (3, 15),
+    (11, 22),
+    (12, 29),
+]
+
+
+def _to_devens(dates: pd.DatetimeIndex) -> np.ndarray:
+    return (dates.year * 10000 + dates.month * 100 + dates.day).to_numpy("int64")
+
+
+@lru_cache
+def _jalali_holidays(year: int) -> tuple[int, ...]:
+    # gregorian dates (yyyymmdd) of the fixed holidays of a jalali year
+
+    return tuple(
+        int(jdate(year, month, day).togregorian().strftime("%Y%m%d"))
+        for month, day in JALALI_HOLIDAYS
+    )
+
+
+class TradingCalendar:
+    """
+    Trading sessions from weekends, official holidays and dates of cached prices.
+    A date with cached prices is a session. Other dates are sessions if they are
+    not in a weekend or a holiday.
+    """
+
+    def __init__(self, holidays: list[int] | None = None) -> None:
+        """
+        :holidays: list[int], holidays (yyyymmdd) other than the fixed ones,
+            e.g. religious holidays of the lunar calendar
+        """
+
+        self.holidays = np.array(sorted(holidays or []), dtype="int64")
+        # dates with prices, sorted
+        self._sessions = np.array([], dtype="int64")
+
+    def add_sessions(self, devens) -> None:
+        """
+        Add dates with prices as sessions.
+
+        :devens: array-like, dates (yyyymmdd) with prices
+        """
+
+        self._sessions = np.union1d(self._sessions, np.asarray(devens, dtype="int64"))
+
+    def sessions(self, start: int, end: int) -> np.ndarray:
+        """
+        Trading sessions in a range of dates.
+
+        :start: int, first date (yyyymmdd)
+        :end: int, last date (yyyymmdd)
+
+        :return: np.ndarray, sorted dates (yyyymmdd) of sessions
+        """
+
+        if end < start:
+            return np.array([], dtype="int64")
+        dates = pd.date_range(str(start), str(end))
+        devens = _to_devens(dates)
+        first, last = (jdate.fromgregorian(date=day.date()) for day in dates[[0, -1]])
+        years = range(first.year, last.year + 1)
+        holidays = np.concatenate(
+            [self.holidays, *[_jalali_holidays(year) for year in years]]
+        )
+        is_session = ~np.isin(dates.weekday, WEEKEND) & ~np.isin(devens, holidays)
+        return devens[is_session | np.isin(devens, self._sessions)]
+
+    def missing_sessions(self, since: int, until: int) -> np.ndarray:
+        """
+        Sessions after a date, e.g. the sessions missing from cached prices.
+
+        :since: int, last date (yyyymmdd) with data
+        :until: int, last date (yyyymmdd) to check
+
+        :return: np.ndarray, sorted dates (yyyymmdd) of sessions after since
+        """
+
+        sessions = self.sessions(since, until)
+        return sessions[sessions > since]
+
+    def count_missing(self, since: pd.Series, until: int) -> pd.Series:
+        """
+        Number of sessions after each date, for many dates at once.
+
+        :since: pd.Series, last dates (yyyymmdd) with data, 0 or NA if none
+        :until: int, last date (yyyymmdd) to check
+
+        :return: pd.Series, number of sessions after each date up to until
+        """
+
+        values = pd.to_numeric(since).astype("float64").fillna(0).to_numpy()
+        known = values[values > 0]
+        start = int(known.min()) if len(known) else until
+        sessions = self.sessions(min(start, until), until)
+        counts = len(sessions) - np.searchsorted(sessions, values, side="right")
+        return pd.Series(counts, index=since.index)
@@ -2,7 +2,10 @@
 Manage TSE Data
 """
 
+import asyncio
 from dataclasses import asdict
+from time import monotonic
+
 import pandas as pd
 
 from dtse import config as cfg
@@ -10,17 +13,88 @@ from dtse import data_services as data_svs
 from dtse.cache_manager import TSECache
 from dtse.price_updater import PriceUpdater
 from dtse.logger import logger as tse_logger
+from dtse.tse_request import TSERequest
+
+# settings that need a new cache if they change between calls of a session
+CACHE_KEYS = [
+    "tse_dir",
+    "TSE_CACHE_DIR",
+    "cache_to_db",
+    "storage_backend",
+    "DB_FILE_NAME",
+    "PARQUET_DIR",
+    "persist_adjusted",
+    # prices in memory are read with these
+    "start_date",
+    "end_date",
+    "price_columns",
+]
 
 
 class TSE:
     """
     Manage TSE Data
+
+    In session mode, the cache, the http client and the results of freshness
+    checks are kept between calls of get_prices. Use it as an async context
+    manager or call close() when done:
+
+        async with TSE(session=True) as tse:
+            prices = await tse.get_prices(["همراه"])
     """
 
-    def __init__(self):
-        self._settings = cfg.default_settings
+    def __init__(self, session: bool = False, ttl: float | None = None):
+        """
+        :session: bool, keep the cache warm between calls of get_prices
+        :ttl: float, seconds to trust freshness checks of a session
+            (default: config.SESSION_TTL)
+        """
+
+        self._settings = dict(cfg.default_settings)
         self._codes: list[int] = []
         self._cache: TSECache | None = None
+        self._session = session
+        self._ttl = ttl if ttl is not None else cfg.SESSION_TTL
+        self._tse_req: TSERequest | None = None
+        self._lock = asyncio.Lock()
+        # times (time.monotonic) of the last freshness checks
+        self._instruments_checked: float | None = None
+        self._prices_checked: dict[int, float] = {}
+        # codes with prices read from the cache storage
+        self._read_codes: set[int] = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        close the http client of the session
+        """
+
+        if self._tse_req is not None:
+            await self._tse_req.close()
+            self._tse_req = None
+
+    def _is_fresh(self, checked: float | None) -> bool:
+        # True if a check of this session is still valid
+
+        return checked is not None and monotonic() - checked < self._ttl
+
+    def _init_cache(self, cache_cfg: dict):
+        # create a cache, or keep the session cache if its storage is the same
+
+        if self._session and self._cache is not None:
+            old_cfg = self._cache.settings
+            if all(old_cfg.get(key) == cache_cfg.get(key) for key in CACHE_KEYS):
+                self._cache.settings = cache_cfg
+                return
+        self._cache = TSECache(cache_cfg)
+        self._instruments_checked = None
+        self._prices_checked = {}
+        self._read_codes = set()
 
     async def _get_expired_prices(self) -> pd.DataFrame:
         """
@@ -33,21 +107,27 @@ class TSE:
         """
 
         first_possible_deven = self._settings["start_date"]
-        sel_insts = self._cache.instruments.loc[self._codes]
-        if self._cache.last_devens is not None and not self._cache.last_devens.empty:
-            sel_insts = sel_insts.join(
-                self._cache.last_devens["LastDEven"]
-                .astype("Int64")
-                .rename("cached_DEven")
-            ).fillna(int(first_possible_deven))
-        else:
-            sel_insts["cached_DEven"] = first_possible_deven
-
-        sel_insts["outdated"] = sel_insts["cached_DEven"].map(
-            lambda deven: data_svs.should_update(
-                str(deven),
-                self._cache.last_possible_deven,
+        codes = [
+            code
+            for code in self._codes
+            if not self._is_fresh(self._prices_checked.get(code))
+        ]
+        sel_insts = self._cache.instruments.loc[codes]
+        last_devens = self._cache.last_devens
+        if last_devens is None:
+            last_devens = pd.DataFrame(
+                columns=["LastDEven", "LastChecked"], dtype="Int64"
             )
+        last_devens = last_devens.reindex(sel_insts.index)
+        # download the days after the last downloaded one, if checked before
+        # the last trading day
+        sel_insts["cached_DEven"] = (
+            last_devens["LastDEven"].fillna(int(first_possible_deven)).astype("int64")
+        )
+        last_checked = last_devens["LastChecked"].fillna(int(first_possible_deven))
+
+        sel_insts["outdated"] = data_svs.should_update_many(
+            last_checked, self._cache.last_possible_deven, self._cache.calendar
         )
         sel_insts["NotInNoMarket"] = (sel_insts.YMarNSC != "NO").astype(int)
         outdated_insts = sel_insts.loc[
@@ -60,6 +140,8 @@ class TSE:
         get prices for symbols
 
         :symbols: list, symbols to get prices for
+        :kwconf: settings to change (see config.default_settings). e.g. "end_date"
+            and "price_columns" limit the prices read from the cache.
 
         :return: dict, prices for symbols
         """
@@ -67,17 +149,40 @@ class TSE:
         if not symbols:
             tse_logger.warning("No symbols requested")
             return {}
-        self._settings = cfg.default_settings
-        if kwconf:
-            self._settings.update(kwconf)
+        async with self._lock:
+            self._settings = dict(cfg.default_settings)
+            if kwconf:
+                self._settings.update(kwconf)
+
+            # Initialize cache
+            cache_cfg = dict(cfg.storage)
+            cache_cfg.update(self._settings)
+            self._init_cache(cache_cfg)
+
+            if self._session:
+                # one pooled http client for all calls of the session
+                if self._tse_req is None:
+                    self._tse_req = TSERequest()
+                await self._tse_req.open()
+                return await self._get_prices(symbols, self._tse_req)
+            # one pooled http client for all requests of this call
+            async with TSERequest() as tse_req:
+                return await self._get_prices(symbols, tse_req)
+
+    async def _get_prices(self, symbols: list[str], tse_req: TSERequest) -> dict:
+        """
+        update and read prices for symbols using an open http client
 
-        # Initialize cache
-        cache_cfg = cfg.storage
-        cache_cfg.update(self._settings)
-        self._cache = TSECache(cache_cfg)
+        :symbols: list, symbols to get prices for
+        :tse_req: TSERequest, open client to send requests with
+
+        :return: dict, prices for symbols
+        """
 
         # Get the latest instuments data
-        await data_svs.update_instruments(self._cache)
+        if not self._is_fresh(self._instruments_checked):
+            await data_svs.update_instruments(self._cache, tse_req)
+            self._instruments_checked = monotonic()
         if self._cache.instruments is None:
             raise ValueError("No instruments loaded.")
 
@@ -95,12 +200,17 @@ class TSE:
         if not_founds:
             tse_logger.warning("symbols not found: %s", ",".join(not_founds))
 
-        self._cache.read_prices(codes=self._codes)
+        new_codes = [code for code in self._codes if code not in self._read_codes]
+        if new_codes:
+            self._cache.read_prices(codes=new_codes)
+            self._read_codes.update(new_codes)
         to_update = await self._get_expired_prices()
+        checked = monotonic()
+        fails = []
         if to_update.empty:
             tse_logger.info("No download needed. Reading from database.")
         else:
-            price_manager = PriceUpdater(cache=self._cache)
+            price_manager = PriceUpdater(cache=self._cache, tse_req=tse_req)
             update_result = await price_manager.update_prices(outdated_insts=to_update)
             if complete_dl := update_result["succs"]:
                 tse_logger.info(
@@ -109,13 +219,28 @@ class TSE:
                 )
             else:
                 tse_logger.info("No data downloaded.")
-            if update_result["fails"]:
+            if fails := update_result["fails"]:
                 tse_logger.warning(
                     "Failed to get some data. codes: %s",
-                    ",".join(update_result["fails"]),
+                    ",".join(map(str, fails)),
                 )
+        failed = set(fails)
+        self._prices_checked.update(
+            (code, checked) for code in self._codes if code not in failed
+        )
         # drop index columns from the list of columns
-        cols = list(asdict(cfg.PriceColNames()).values())[2:]
+        cols = (
+            self._settings["price_columns"]
+            or list(asdict(cfg.PriceColNames()).values())[2:]
+        )
+        if self._cache.workers > 1:
+            # keep the event loop free while worker processes run
+            res = await asyncio.to_thread(
+                self._cache.prices_by_symbol, symbols=symbols, cols=cols
+            )
+            if self._settings["write_csv"]:
+                await asyncio.to_thread(self._cache.write_prc_csv, res)
+            return res
         res = self._cache.prices_by_symbol(symbols=symbols, cols=cols)
 
         if self._settings["write_csv"]:
@@ -11,8 +11,67 @@ from dtse.logger import logger as tse_logger
 class TSERequest:
     """
     send api request to tse and return string data
+
+    Use it as an async context manager to share one pooled session between
+    requests. Outside of a context, each request opens its own session.
     """
 
+    def __init__(
+        self,
+        pool: dict | None = None,
+        timeout: float | None = None,
+        api_url: str | None = None,
+    ):
+        """
+        Initialize the client.
+
+        :param pool: dict, connection pool settings (see config.HTTP_POOL)
+        :param timeout: float, total timeout for each request in seconds
+        :param api_url: str, url of the api. default: config.API_URL
+        """
+
+        self._api_url = api_url or settings.API_URL
+
+        self._pool = dict(settings.HTTP_POOL)
+        if pool:
+            self._pool.update(pool)
+        self._timeout = aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else settings.HTTP_TIMEOUT
+        )
+        self._session: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def is_open(self) -> bool:
+        """True if the shared session is open"""
+        return self._session is not None and not self._session.closed
+
+    async def open(self) -> None:
+        """
+        open the shared session and its connection pool
+        """
+
+        if not self.is_open:
+            connector = aiohttp.TCPConnector(**self._pool)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self._timeout
+            )
+
+    async def close(self) -> None:
+        """
+        close the shared session and release pooled connections
+        """
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     async def instrument(self, last_date: str):
         """
         request instrument data from tsetmc API
@@ -72,8 +131,15 @@ class TSERequest:
         :raise: aiohttp.ClientResponseError, if request failed
         """
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(settings.API_URL, params=params) as response:
-                if response.status != 200:
-                    response.raise_for_status()
-                return await response.text()
+        if self.is_open:
+            return await self._get(self._session, params)
+        async with aiohttp.ClientSession(timeout=self._timeout) as session:
+            return await self._get(session, params)
+
+    async def _get(self, session: aiohttp.ClientSession, params: dict) -> str:
+        # send a GET request using session
+
+        async with session.get(self._api_url, params=params) as response:
+            if response.status != 200:
+                response.raise_for_status()
+            return await response.text()
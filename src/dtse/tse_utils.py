@@ -3,10 +3,26 @@ helper functions to parse tse data
 """
 
 
-import re
+from functools import lru_cache
+from io import StringIO
 
+import numpy as np
+import pandas as pd
 from jdatetime import date as jdate
 
+from dtse import config as cfg
+
+
+@lru_cache(maxsize=2**14)
+def _to_jalali(date: int) -> str:
+    # jalali date of a gregorian date, recent conversions are reused
+
+    return jdate.fromgregorian(
+        day=date % 100,
+        month=date // 100 % 100,
+        year=date // 10000,
+    ).strftime("%Y/%m/%d")
+
 
 def to_jalali_date(date) -> str:
     """
@@ -17,32 +33,34 @@ def to_jalali_date(date) -> str:
     :return: str, date in jalali calendar formatted like yyyy/mm/dd
     """
 
-    date = str(date)
-    return jdate.fromgregorian(
-        day=int(date[-2:]),
-        month=int(date[4:6]),
-        year=int(date[:4]),
-    ).strftime("%Y/%m/%d")
-
+    return _to_jalali(int(date))
 
-def _replace(string, dictionary) -> str:
-    if not isinstance(string, str):
-        raise TypeError("accept string type")
 
-    pattern = re.compile("|".join(dictionary.keys()))
-    return pattern.sub(lambda x: dictionary[x.group()], string)
+def to_jalali_dates(dates, known: dict[int, str] | None = None) -> np.ndarray:
+    """
+    convert many gregorian dates to jalali dates, each distinct date only once
 
+    :param dates: array-like of int, gregorian dates formatted like yyyymmdd
+    :param known: dict, optional, known jalali dates of gregorian dates, e.g.
+        read from the cache. new conversions are added to it.
 
-def clean_fa(text) -> str:
+    :return: np.ndarray, dates in jalali calendar formatted like yyyy/mm/dd
     """
-    clean persian texts
 
-    :param text: str, text to clean
+    codes, uniques = pd.factorize(np.asarray(dates, dtype="int64"))
+    if known is None:
+        known = {}
+    jalali = []
+    for date in uniques.tolist():
+        if date not in known:
+            known[date] = _to_jalali(date)
+        jalali.append(known[date])
+    return np.array(jalali, dtype=object)[codes]
 
-    :return: str, cleaned text
-    """
 
-    characters_map = {
+# translation table of persian texts, built once
+_FA_CHARACTERS = str.maketrans(
+    {
         "\u200B": "",  # zero-width space
         "\u200C": " ",  # zero-width non-joiner
         "\u200D": "",  # zero-width joiner
@@ -50,5 +68,98 @@ def clean_fa(text) -> str:
         "ي": "ی",
         "ك": "ک",
     }
-    text = _replace(text, characters_map).strip()
-    return text
+)
+
+
+def clean_fa(text) -> str:
+    """
+    clean persian texts
+
+    :param text: str, text to clean
+
+    :return: str, cleaned text
+    """
+
+    if not isinstance(text, str):
+        raise TypeError("accept string type")
+    return text.translate(_FA_CHARACTERS).strip()
+
+
+def clean_fa_series(texts: pd.Series) -> pd.Series:
+    """
+    clean a column of persian texts in one pass
+
+    :param texts: pd.Series, texts to clean. missing values stay missing.
+
+    :return: pd.Series, cleaned texts
+    """
+
+    return texts.str.translate(_FA_CHARACTERS).str.strip()
+
+
+def to_prices_dtypes(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    cast columns of daily prices to the compact dtypes of the config
+    (see config.tse_closing_prices_dtypes and its precision policy).
+    the dtypes are the same for every block of prices, so blocks are joined
+    without upcasting. missing values are kept, in the nullable version of
+    the dtype of their column.
+
+    :param data: pd.DataFrame, daily prices with columns of tse_closing_prices_info
+
+    :return: pd.DataFrame, daily prices with compact dtypes
+
+    :raises ValueError: if a value is fractional or out of the range of its dtype
+    """
+
+    data = data.copy()
+    for col, dtype in cfg.tse_closing_prices_dtypes.items():
+        if col not in data.columns:
+            continue
+        values = pd.to_numeric(data[col])
+        limits = np.iinfo(dtype)
+        valid = values.dropna()
+        fits = valid.between(limits.min, limits.max)
+        if not pd.api.types.is_integer_dtype(values.dtype):
+            fits &= valid == valid.round()
+        if not fits.all():
+            raise ValueError(
+                f"{(~fits).sum()} values of {col} do not fit in {dtype}, "
+                f"e.g. {valid[~fits].iloc[0]}"
+            )
+        if len(valid) < len(values):
+            # e.g. "int64" -> "Int64", "uint32" -> "UInt32"
+            dtype = dtype.replace("uint", "UInt").replace("int", "Int")
+        data[col] = values.astype(dtype)
+    return data
+
+
+def parse_closing_prices(response: str, n_codes: int) -> pd.DataFrame:
+    """
+    parse a whole "ClosingPrices" response in a single pass
+
+    :param response: str, prices of instruments separated by "@"
+    :param n_codes: int, number of requested instrument codes
+
+    :return: pd.DataFrame, prices indexed by InsCode and DEven, with compact dtypes
+
+    :raise: ValueError, if the number of instruments does not match n_codes
+    """
+
+    n_resp = response.count("@") + 1
+    if n_resp != n_codes:
+        raise ValueError(f"requested {n_codes} codes, got {n_resp}")
+    col_names = cfg.tse_closing_prices_info
+    index_cols = col_names[:2]
+    line_terminator = cfg.RESP_LN_TERMINATOR
+    if not response.strip("@" + line_terminator):
+        prices = pd.DataFrame(columns=col_names)
+    else:
+        # instruments become blocks of lines, empty ones become blank lines
+        prices = pd.read_csv(
+            StringIO(response.replace("@", line_terminator)),
+            names=col_names,
+            lineterminator=line_terminator,
+            dtype=dict.fromkeys(index_cols, "int64"),
+        )
+    return to_prices_dtypes(prices).set_index(index_cols)
@@ -0,0 +1,55 @@
+"""
+fixtures of the benchmarks
+
+The market has DTSE_BENCH_INSTRUMENTS symbols (default: 3000) with
+DTSE_BENCH_YEARS years (default: 15) of prices. Benchmarks only run with
+"--benchmark-only", e.g.:
+
+    DTSE_BENCH_INSTRUMENTS=500 pytest tests/benchmarks --benchmark-only
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from dtse import config as cfg
+
+from .market import Market, generate_market
+
+
+def pytest_collection_modifyitems(config, items):
+    """skip benchmarks in normal test runs"""
+
+    if config.getoption("benchmark_only", default=False):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark-only")
+    for item in items:
+        if "benchmark" in getattr(item, "fixturenames", ()):
+            item.add_marker(skip)
+
+
+@pytest.fixture(name="market", scope="session")
+def fixture_market() -> Market:
+    """
+    synthetic market shared by the benchmarks
+    """
+
+    return generate_market(
+        n_instruments=int(os.environ.get("DTSE_BENCH_INSTRUMENTS", 3000)),
+        years=int(os.environ.get("DTSE_BENCH_YEARS", 15)),
+    )
+
+
+@pytest.fixture(name="bench_settings")
+def fixture_bench_settings(tmp_path: Path) -> dict:
+    """
+    settings of a cache in a new directory, without writing to db
+    """
+
+    settings = dict(cfg.storage)
+    settings.update(cfg.default_settings)
+    settings.update(
+        {"cache_to_db": False, "tse_dir": tmp_path, "start_date": "20000101"}
+    )
+    return settings
@@ -0,0 +1,107 @@
+"""
+local http server answering price requests from a synthetic market
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from aiohttp import web
+
+from dtse import config as cfg
+
+from .market import Market
+
+
+class FakeTsetmc:
+    """
+    Serve "ClosingPrices" and "LastPossibleDeven" of a market on localhost.
+    Use it as an async context manager, it returns the url of the api.
+    """
+
+    def __init__(self, market: Market) -> None:
+        """
+        :market: Market, market to serve
+        """
+
+        self.market = market
+        self.n_requests = 0
+        # response lines of each code and their dates, built on first request
+        self._lines: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self._codes: np.ndarray | None = None
+        self._runner: web.AppRunner | None = None
+
+    async def __aenter__(self) -> str:
+        app = web.Application()
+        app.router.add_get("/", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}/"
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._runner.cleanup()
+
+    @contextmanager
+    def in_thread(self):
+        """
+        Serve on an event loop of another thread, e.g. to keep the work of the
+        server out of a loop that is timed. It returns the url of the api.
+        """
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            yield asyncio.run_coroutine_threadsafe(self.__aenter__(), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(
+                self.__aexit__(None, None, None), loop
+            ).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def _code_lines(self, code: int) -> tuple[np.ndarray, np.ndarray]:
+        # dates and csv lines of the prices of a code
+
+        if code not in self._lines:
+            if self._codes is None:
+                self._codes = self.market.prices.index.get_level_values(0).to_numpy()
+            # prices are sorted by code
+            start, stop = np.searchsorted(self._codes, [code, code + 1])
+            data = self.market.prices.iloc[start:stop].reset_index()
+            data = data[cfg.tse_closing_prices_info]
+            lines = data.astype(str).agg(",".join, axis=1).to_numpy(dtype=str)
+            self._lines[code] = data["DEven"].to_numpy(), lines
+        return self._lines[code]
+
+    def closing_prices(self, param: str) -> str:
+        """
+        Prices of the requested codes after their dates, like the api.
+
+        :param: str, "code,date,flag" of codes separated by ";"
+
+        :return: str, prices of each code separated by "@"
+        """
+
+        blocks = []
+        for row in param.split(cfg.RESP_LN_TERMINATOR):
+            code, deven = (int(value) for value in row.split(",")[:2])
+            devens, lines = self._code_lines(code)
+            start = np.searchsorted(devens, deven, side="right")
+            blocks.append(cfg.RESP_LN_TERMINATOR.join(lines[start:]))
+        return "@".join(blocks)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.n_requests += 1
+        kind = request.query.get("t")
+        if kind == "ClosingPrices":
+            return web.Response(text=self.closing_prices(request.query["a"]))
+        if kind == "LastPossibleDeven":
+            end = self.market.end_date
+            return web.Response(text=f"{end};{end}")
+        raise web.HTTPNotFound()
@@ -0,0 +1,147 @@
+"""
+deterministic synthetic market data for benchmarks
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from dtse import config as cfg
+from dtse.trading_calendar import TradingCalendar
+from dtse.tse_utils import to_prices_dtypes
+
+
+@dataclass
+class Market:
+    """
+    Instruments, splits and daily prices of a synthetic market.
+    """
+
+    instruments: pd.DataFrame  # indexed by InsCode
+    splits: pd.DataFrame  # indexed by InsCode and DEven
+    prices: pd.DataFrame  # indexed by InsCode and DEven, sorted
+    end_date: int
+
+    @property
+    def groups(self) -> pd.Series:
+        """symbol of each code"""
+        return self.instruments["Symbol"]
+
+
+def _prices_of_code(
+    rng: np.random.Generator, code: int, devens: np.ndarray, nominal: bool
+) -> tuple[pd.DataFrame, list]:
+    # random walk of prices with yearly dividends and maybe a split
+
+    n_days = len(devens)
+    returns = rng.normal(0.0005, 0.02, n_days)
+    splits = []
+    if n_days > 300 and rng.random() < 0.3:
+        # new shares are issued: prices are halved from the split day
+        day = int(rng.integers(100, n_days - 100))
+        returns[day] -= np.log(2)
+        splits.append((code, devens[day], 2_000_000, 1_000_000))
+    closing = np.clip(rng.integers(1_000, 50_000) * np.exp(np.cumsum(returns)), 10, 1e8)
+    closing = np.round(closing).astype("int64")
+    yesterday = np.roll(closing, 1)
+    yesterday[0] = closing[0]
+    for day in range(240, n_days, 240):
+        # cash dividend: the base price drops
+        yesterday[day] = round(closing[day - 1] * (1 - rng.uniform(0.02, 0.15)))
+    for _, deven, new, old in splits:
+        day = int(np.searchsorted(devens, deven))
+        yesterday[day] = round(closing[day - 1] * old / new)
+    trades = rng.integers(1, 3_000, n_days)
+    trades[rng.random(n_days) < 0.05] = 0
+    if nominal:
+        # first days in a new market: nominal price and no trades
+        closing[:3] = yesterday[:3] = cfg.storage["NOMINAL_PRICES"][0]
+        trades[:3] = 0
+    volume = trades * rng.integers(100, 10_000, n_days)
+    prices = pd.DataFrame(
+        {
+            "InsCode": code,
+            "DEven": devens,
+            "PClosing": closing,
+            "PDrCotVal": closing,
+            "ZTotTran": trades,
+            "QTotTran5J": volume,
+            "QTotCap": volume * closing,
+            "PriceMin": np.round(closing * 0.97).astype("int64"),
+            "PriceMax": np.round(closing * 1.03).astype("int64"),
+            "PriceYesterday": yesterday,
+            "PriceFirst": yesterday,
+        }
+    )
+    return prices, splits
+
+
+def generate_market(
+    n_instruments: int = 3000, years: int = 15, seed: int = 0, end_date: int = 20240319
+) -> Market:
+    """
+    Generate a market. One in twenty symbols moves to a new market and has two
+    codes, about a third of the codes have a split. The same arguments give
+    the same market.
+
+    :n_instruments: int, number of symbols
+    :years: int, years of prices
+    :seed: int, seed of the random generator
+    :end_date: int, last date (yyyymmdd) with prices
+
+    :return: Market
+    """
+
+    rng = np.random.default_rng(seed)
+    sessions = TradingCalendar().sessions(end_date - years * 10000, end_date)
+    n_days = len(sessions)
+    n_moves = n_instruments // 20
+    n_codes = n_instruments + n_moves
+    # unique codes in the range of real ones
+    codes = (
+        10**16 + np.arange(n_codes) * 1_000_003 + rng.integers(0, 1_000_003, n_codes)
+    )
+    symbols = [f"SYM{i:04d}" for i in range(n_instruments)]
+    code_symbols = symbols + symbols[:n_moves]
+    markets = ["ID"] * n_instruments
+    markets[:n_moves] = ["NO"] * n_moves
+
+    blocks, splits = [], []
+    for i in range(n_instruments):
+        # half of the symbols are listed after the first day
+        first = 0 if i % 2 else int(rng.integers(0, n_days * 0.8))
+        if i < n_moves:
+            move = int(rng.integers(first + 50, n_days - 10))
+            spans = [
+                (codes[i], first, move, False),
+                (codes[n_instruments + i], move, n_days, True),
+            ]
+        else:
+            spans = [(codes[i], first, n_days, False)]
+        for code, start, stop, nominal in spans:
+            prices, code_splits = _prices_of_code(
+                rng, int(code), sessions[start:stop], nominal
+            )
+            blocks.append(prices)
+            splits.extend(code_splits)
+
+    prices = to_prices_dtypes(pd.concat(blocks, ignore_index=True))
+    instruments = pd.DataFrame(
+        "", index=pd.Index(codes, name="InsCode"), columns=cfg.tse_instrument_info[1:]
+    )
+    instruments["Symbol"] = code_symbols
+    instruments["Name"] = code_symbols
+    instruments["YMarNSC"] = markets + ["ID"] * n_moves
+    instruments["DEven"] = end_date
+    instruments["Flow"] = 1
+    splits = pd.DataFrame(
+        splits, columns=["InsCode", "DEven", "NumberOfShareNew", "NumberOfShareOld"]
+    )
+    splits.insert(0, "Idn", np.arange(1, len(splits) + 1))
+    return Market(
+        instruments=instruments,
+        splits=splits.set_index(["InsCode", "DEven"]),
+        prices=prices.set_index(["InsCode", "DEven"]).sort_index(),
+        end_date=end_date,
+    )
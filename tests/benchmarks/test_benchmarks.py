@@ -0,0 +1,225 @@
+"""
+time and peak memory of the hot paths on a synthetic full market
+
+Each benchmark records the peak memory (MB) of one extra run traced by
+tracemalloc in "extra_info", so the timed rounds are not slowed down.
+"""
+
+import asyncio
+import tracemalloc
+from itertools import count
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from dtse import config as cfg
+from dtse.cache_manager import TSECache
+from dtse.price_adjuster import adjust_prices
+from dtse.price_updater import PriceUpdater
+from dtse.tse_request import TSERequest
+from dtse.tse_utils import parse_closing_prices
+
+from .fake_tsetmc import FakeTsetmc
+from .market import Market
+
+pytest.importorskip("pytest_benchmark")
+
+ROUNDS = 3
+# codes downloaded from the fake api in the update benchmark
+UPDATE_CODES = 500
+
+
+def _run(benchmark, func, setup=None, rounds: int = ROUNDS):
+    # time func and record the peak memory of one more run
+
+    def _setup():
+        return ((setup(),), {}) if setup else ((), {})
+
+    res = benchmark.pedantic(func, setup=_setup, rounds=rounds)
+    args, _ = _setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["peak_memory_mb"] = round(peak / 2**20, 1)
+    return res
+
+
+def _outdated(market: Market, codes) -> pd.DataFrame:
+    # codes to download from their first date
+    return market.instruments.loc[codes, []].assign(DEven=0, NotInNoMarket=1)
+
+
+def _cache(market: Market, settings: dict) -> TSECache:
+    # cache with the instruments, splits and prices of the market
+    cache = TSECache(settings=settings)
+    cache.instruments = market.instruments
+    cache.splits = market.splits
+    cache.add_to_prices([market.prices])
+    return cache
+
+
+@pytest.fixture(name="loop")
+def fixture_loop():
+    """
+    event loop to run timed coroutines on, created before timing
+    """
+
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(name="chunk")
+def fixture_chunk(market: Market):
+    """
+    a chunk of codes with their whole history and its api response
+    """
+
+    codes = market.instruments.index[: cfg.PRICES_UPDATE_CHUNK]
+    chunk = _outdated(market, codes)
+    param = chunk.to_csv(header=False, lineterminator=cfg.RESP_LN_TERMINATOR)[:-1]
+    return chunk, FakeTsetmc(market).closing_prices(param)
+
+
+def test_parse_closing_prices(benchmark, chunk):
+    """
+    parse a response of a chunk of codes
+    """
+
+    chunk, response = chunk
+    res = _run(benchmark, lambda: parse_closing_prices(response, len(chunk)))
+    assert len(res)
+
+
+def test_on_result(benchmark, chunk, bench_settings: dict, loop):
+    """
+    add a parsed response to the cache
+    """
+
+    chunk, response = chunk
+
+    def setup():
+        updater = PriceUpdater(TSECache(settings=bench_settings))
+        updater._start_jobs(chunk)
+        return updater
+
+    def on_result(updater):
+        loop.run_until_complete(updater._on_result(response, chunk))
+        return updater
+
+    updater = _run(benchmark, on_result, setup)
+    assert len(updater.succs) == len(chunk)
+
+
+def test_update_prices(benchmark, market: Market, bench_settings: dict, loop):
+    """
+    download prices of many codes from the fake api
+    """
+
+    codes = market.instruments.index[:UPDATE_CODES]
+    outdated = _outdated(market, codes)
+    server = FakeTsetmc(market)
+    # build the responses of the codes before timing
+    server.closing_prices(
+        outdated.to_csv(header=False, lineterminator=cfg.RESP_LN_TERMINATOR)[:-1]
+    )
+
+    # the server runs on a loop of another thread, the timed loop only runs
+    # the updates. both still share the process (and the GIL).
+    with server.in_thread() as url:
+
+        def setup():
+            return PriceUpdater(
+                TSECache(settings=bench_settings),
+                TSERequest(api_url=url),
+                limiter={"min_interval": 0},
+            )
+
+        res = _run(
+            benchmark,
+            lambda updater: loop.run_until_complete(updater.update_prices(outdated)),
+            setup,
+        )
+    assert len(res["succs"]) == len(codes)
+
+
+def test_adjust_prices(benchmark, market: Market):
+    """
+    adjust prices of all codes for dividends and splits
+    """
+
+    res = _run(
+        benchmark,
+        lambda: adjust_prices(
+            market.prices,
+            market.groups,
+            1,
+            splits=market.splits,
+            nominal_prices=cfg.storage["NOMINAL_PRICES"],
+        ),
+    )
+    assert len(res) == len(market.prices)
+
+
+def test_prices_by_symbol(benchmark, market: Market, bench_settings: dict):
+    """
+    adjusted prices of all symbols
+    """
+
+    bench_settings.update({"adjust_prices": 1, "days_without_trade": True})
+    symbols = market.groups.unique().tolist()
+    cols = ["PClosing", "AdjPClosing", "ZTotTran"]
+
+    res = _run(
+        benchmark,
+        lambda cache: cache.prices_by_symbol(symbols, cols),
+        setup=lambda: _cache(market, bench_settings),
+    )
+    assert len(res) == len(symbols)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+def test_prices_to_db(
+    benchmark, market: Market, bench_settings: dict, tmp_path: Path, backend: str
+):
+    """
+    write prices of all codes to an empty storage
+    """
+
+    if backend == "parquet":
+        pytest.importorskip("pyarrow")
+    dirs = count()
+
+    def setup():
+        settings = dict(bench_settings)
+        settings.update(
+            {
+                "cache_to_db": True,
+                "storage_backend": backend,
+                "tse_dir": tmp_path / str(next(dirs)),
+            }
+        )
+        return TSECache(settings=settings)
+
+    _run(benchmark, lambda cache: cache._prices_to_db(market.prices), setup)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+def test_read_prc(benchmark, market: Market, bench_settings: dict, backend: str):
+    """
+    read prices of all codes from the storage
+    """
+
+    if backend == "parquet":
+        pytest.importorskip("pyarrow")
+    bench_settings.update({"cache_to_db": True, "storage_backend": backend})
+    cache = TSECache(settings=bench_settings)
+    cache._prices_to_db(market.prices)
+    codes = market.instruments.index.to_list()
+
+    res = _run(benchmark, lambda: cache._read_prc(codes))
+    assert len(res) == len(market.prices)
@@ -0,0 +1,55 @@
+"""test the synthetic market and the fake api of the benchmarks"""
+
+import pandas as pd
+
+from dtse import config as cfg
+from dtse.cache_manager import TSECache
+from dtse.price_updater import PriceUpdater
+from dtse.tse_request import TSERequest
+
+from .fake_tsetmc import FakeTsetmc
+from .market import generate_market
+
+
+def test_generate_market():
+    """
+    test the market is reproducible and has moves, splits and nominal prices
+    """
+
+    market = generate_market(n_instruments=40, years=3)
+    pd.testing.assert_frame_equal(
+        market.prices, generate_market(n_instruments=40, years=3).prices
+    )
+    assert market.prices.index.is_monotonic_increasing
+    assert market.groups.duplicated().sum() == 2
+    assert set(market.splits.index.unique("InsCode")) <= set(market.instruments.index)
+    assert not market.splits.empty
+    nominal = market.prices["PClosing"] == cfg.storage["NOMINAL_PRICES"][0]
+    assert nominal.sum() >= 2 * 3
+
+
+async def test_fake_tsetmc(tmp_path):
+    """
+    test downloading prices from the fake api
+    """
+
+    market = generate_market(n_instruments=20, years=1)
+    codes = market.instruments.index[:3]
+    since = 20240101
+    outdated = pd.DataFrame({"DEven": since, "NotInNoMarket": 1}, index=codes)
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": False, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    async with FakeTsetmc(market) as url:
+        assert await TSERequest(api_url=url).last_possible_deven() == (
+            f"{market.end_date};{market.end_date}"
+        )
+        updater = PriceUpdater(
+            cache, TSERequest(api_url=url), limiter={"min_interval": 0}
+        )
+        res = await updater.update_prices(outdated)
+
+    assert sorted(res["succs"]) == sorted(codes)
+    expected = market.prices.loc[list(codes)]
+    expected = expected[expected.index.get_level_values("DEven") > since]
+    pd.testing.assert_frame_equal(cache.prices, expected)
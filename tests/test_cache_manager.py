@@ -1,14 +1,17 @@
 """test chache_manager"""
 
+import datetime
 from collections.abc import Generator
 from pathlib import Path
 
 import pandas as pd
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 
+from dtse import cache_manager, data_services, storage, tse_utils
 from dtse import config as cfg
 from dtse.cache_manager import TSECache
+from dtse.storage import SQLiteStorage
 
 
 @pytest.fixture(name="test_cache")
@@ -63,14 +66,17 @@ def test_read_prices(mocker, codes, test_cache):
     engine = create_engine("sqlite://", echo=True)
     with engine.connect() as conn:
         expected_res.to_sql(name="daily_prices", con=conn)
-    _ = mocker.patch.object(cache, "_engine", new=engine)
+    _ = mocker.patch.object(cache, "_storage", new=SQLiteStorage(engine))
     mock_sql = mocker.patch("dtse.cache_manager.pd.read_sql_query")
-    mock_sql.return_value = expected_res
+    mock_sql.return_value = expected_res.reset_index()
     selected_syms_file = "sample_data/sample_selected_syms.csv"
     selected_syms = pd.read_csv(
         selected_syms_file, encoding="utf-8", index_col="InsCode"
     )
     cache.read_prices(selected_syms.index.to_list())
+    expected_res = tse_utils.to_prices_dtypes(expected_res.reset_index()).set_index(
+        ["InsCode", "DEven"]
+    )
     pd.testing.assert_frame_equal(cache.prices, expected_res)
 
 
@@ -135,3 +141,465 @@ def test_adjust(
             atol=10,
             check_dtype=False,
         )
+
+
+def test_add_to_prices(test_cache: TSECache):
+    """
+    test buffering and merging of added prices
+    """
+
+    cache = test_cache
+    codes = [35796086458096255, 71483646978964608, 9211775239375291]
+    blocks = [
+        pd.read_csv(
+            f"sample_data/prices_not_adj/{str(code)}.csv",
+            index_col=["InsCode", "DEven"],
+        )
+        for code in codes
+    ]
+    for block in blocks:
+        assert cache.add_to_prices([block])
+    assert not cache.add_to_prices([blocks[0].iloc[:0]])
+    assert cache._prices is None
+    expected_res = pd.concat(blocks).sort_index()
+    pd.testing.assert_frame_equal(cache.prices, expected_res)
+
+    # a re-downloaded row replaces the cached one
+    new_row = blocks[0].iloc[-1:].copy()
+    new_row["PClosing"] = 1
+    cache.add_to_prices([new_row])
+    assert len(cache.prices) == len(expected_res)
+    assert cache.prices.loc[new_row.index[0], "PClosing"] == 1
+
+    # changing the returned prices does not change the cache
+    prices = cache.prices
+    prices["PClosing"] = 0
+    assert cache.prices.loc[new_row.index[0], "PClosing"] == 1
+
+
+def test_prices_to_db_upsert(tmp_path: Path):
+    """
+    test writing the same prices twice does not duplicate rows
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    prices = pd.read_csv(
+        "sample_data/prices_not_adj/35796086458096255.csv",
+        index_col=["InsCode", "DEven"],
+    ).drop(columns="Symbol")
+    cache = TSECache(settings=settings)
+    cache.add_to_prices([prices])
+    cache.add_to_prices([prices.iloc[-10:]])
+    engine = create_engine("sqlite:///" + str(tmp_path / settings["DB_FILE_NAME"]))
+    with engine.connect() as conn:
+        res = pd.read_sql_table("daily_prices", conn, index_col=["InsCode", "DEven"])
+    assert len(res) == len(prices)
+    assert inspect(engine).get_pk_constraint("daily_prices")["constrained_columns"] == [
+        "InsCode",
+        "DEven",
+    ]
+
+
+def test_prices_table_migration(tmp_path: Path):
+    """
+    test removing duplicates from a price table without primary key
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    prices = pd.read_csv(
+        "sample_data/prices_not_adj/35796086458096255.csv",
+        index_col=["InsCode", "DEven"],
+    ).drop(columns="Symbol")
+    engine = create_engine("sqlite:///" + str(tmp_path / settings["DB_FILE_NAME"]))
+    with engine.connect() as conn:
+        pd.concat([prices, prices.iloc[-5:]]).to_sql("daily_prices", conn)
+    # the table is migrated on first use
+    settings["start_date"] = "20000101"
+    cache = TSECache(settings=settings)
+    cache.read_prices([35796086458096255])
+    assert len(cache.prices) == len(prices)
+    with engine.connect() as conn:
+        res = pd.read_sql_table("daily_prices", conn, index_col=["InsCode", "DEven"])
+    assert len(res) == len(prices)
+
+
+def test_last_devens_watermark(tmp_path: Path):
+    """
+    test storing the last downloaded date and migrating an old last_devens table
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    engine = create_engine("sqlite:///" + str(tmp_path / settings["DB_FILE_NAME"]))
+    with engine.connect() as conn:
+        old = pd.DataFrame({"LastDEven": ["20240101"]}, index=pd.Index([1]))
+        old.to_sql("last_devens", conn, index_label="InsCode")
+        conn.commit()
+    cache = TSECache(settings=settings)
+    assert cache.last_devens.loc[1].to_list() == [20240101, 20240101]
+
+    new_prices = pd.DataFrame(
+        {"PClosing": [1, 2, 3]},
+        index=pd.MultiIndex.from_tuples(
+            [(1, 20240301), (1, 20240302), (2, 20240201)], names=["InsCode", "DEven"]
+        ),
+    )
+    cache.update_last_devens([1, 2, 3], new_prices)
+    cache.add_to_prices([new_prices])
+    cache.update_last_devens([2])
+    # codes without new prices are stored too
+    cache.add_to_prices([])
+
+    res = TSECache(settings=settings).last_devens.sort_index()
+    assert res["LastDEven"].to_list() == [20240302, 20240201, pd.NA]
+    assert res["LastChecked"].nunique() == 1
+    assert res["LastChecked"].iloc[0] > 20240302
+
+
+def test_last_checked_session(mocker, tmp_path: Path):
+    """
+    test a session published after a check is still downloaded
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": False, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    now = datetime.datetime(2026, 10, 18, 10)
+    mock_date = mocker.patch("dtse.data_services.datetime", wraps=datetime.datetime)
+    mock_date.now.return_value = now
+    mocker.patch("dtse.cache_manager.date", wraps=datetime.date).today.return_value = (
+        now.date()
+    )
+
+    # checked on 20261018 while the server is still at 20261017
+    cache.last_possible_deven = "20261017"
+    cache.update_last_devens([1])
+    last_checked = cache.last_devens["LastChecked"]
+    assert last_checked.to_list() == [20261017]
+
+    mock_date.now.return_value = now.replace(hour=18)
+    cache.last_possible_deven = "20261018"
+    res = data_services.should_update_many(
+        last_checked, cache.last_possible_deven, cache.calendar
+    )
+    assert res.to_list() == [True]
+
+
+def test_sqlite_profile(tmp_path: Path):
+    """
+    test pragmas and indexes of the cache database
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    cache.instruments = pd.read_csv("sample_data/instruments.csv", index_col="InsCode")
+    cache.splits = pd.read_csv("sample_data/shares.csv", index_col=["InsCode", "DEven"])
+    cache.instruments_to_db()
+    engine = cache._storage._engine
+    with engine.connect() as conn:
+        journal_mode = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+        synchronous = conn.exec_driver_sql("PRAGMA synchronous").scalar()
+    assert journal_mode == "wal"
+    assert synchronous == 1  # NORMAL
+    indexes = inspect(engine).get_indexes("splits")
+    assert "ix_splits_InsCode_DEven" in [index["name"] for index in indexes]
+
+
+def test_parquet_storage(tmp_path: Path):
+    """
+    test reading and writing with the parquet storage backend
+    """
+
+    pytest.importorskip("pyarrow")
+    settings = dict(cfg.storage)
+    settings.update(
+        {
+            "cache_to_db": True,
+            "tse_dir": tmp_path,
+            "storage_backend": "parquet",
+            "start_date": "20200101",
+        }
+    )
+    codes = [71483646978964608, 9211775239375291]
+    prices = pd.concat(
+        [
+            pd.read_csv(
+                f"sample_data/prices_not_adj/{str(code)}.csv",
+                index_col=["InsCode", "DEven"],
+            ).drop(columns="Symbol")
+            for code in codes
+        ]
+    ).sort_index()
+    instruments = pd.read_csv("sample_data/instruments.csv", index_col="InsCode")
+    cache = TSECache(settings=settings)
+    cache.add_to_prices([prices])
+    cache.add_to_prices([prices.iloc[-10:]])
+    cache.instruments = instruments
+    cache.instruments_to_db()
+
+    new_cache = TSECache(settings=settings)
+    pd.testing.assert_frame_equal(new_cache.instruments, instruments)
+    new_cache.read_prices(codes)
+    expected_res = prices[prices.index.get_level_values("DEven") >= 20200101]
+    expected_res = (
+        expected_res.reset_index()
+        .astype(cfg.tse_closing_prices_dtypes)
+        .set_index(["InsCode", "DEven"])
+    )
+    pd.testing.assert_frame_equal(new_cache.prices, expected_res)
+
+
+def test_incomplete_storage_backend():
+    """
+    test a backend that misses methods of the interface can not be created
+    """
+
+    class ReadOnlyStorage(storage.StorageBackend):
+        # only reads tables
+        def read_table(self, table_name, index_col):
+            return None
+
+    with pytest.raises(TypeError, match="write_table"):
+        ReadOnlyStorage()
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+def test_read_prices_projection(tmp_path: Path, backend: str):
+    """
+    test reading a date range and some columns of prices
+    """
+
+    if backend == "parquet":
+        pytest.importorskip("pyarrow")
+    settings = dict(cfg.storage)
+    settings.update(
+        {
+            "cache_to_db": True,
+            "tse_dir": tmp_path,
+            "storage_backend": backend,
+            "start_date": "20200101",
+        }
+    )
+    code = 35796086458096255
+    prices = pd.read_csv(
+        f"sample_data/prices_not_adj/{str(code)}.csv",
+        index_col=["InsCode", "DEven"],
+    ).drop(columns="Symbol")
+    TSECache(settings=settings).add_to_prices([prices])
+
+    cache = TSECache(settings=settings)
+    cache.read_prices([code], end_date=20210101, columns=["PClosing", "QTotCap"])
+    res = cache.prices
+    dates = res.index.get_level_values("DEven")
+    assert dates.min() >= 20200101
+    assert dates.max() <= 20210101
+    assert dates.dtype == "int32"
+    assert list(res.columns) == [
+        "PClosing",
+        "ZTotTran",
+        "QTotTran5J",
+        "QTotCap",
+        "PriceYesterday",
+    ]
+    assert res["ZTotTran"].dtype == "uint32"
+    assert res["PClosing"].dtype == "int64"
+    expected = prices.loc[res.index, res.columns]
+    pd.testing.assert_frame_equal(
+        res, expected, check_dtype=False, check_index_type=False
+    )
+
+
+def _adjusted_cache(tmp_path: Path, **kwargs) -> TSECache:
+    # cache with sample prices, ready for prices_by_symbol
+
+    settings = dict(cfg.storage)
+    settings.update(cfg.default_settings)
+    settings.update({"tse_dir": tmp_path, "adjust_prices": 1})
+    settings.update(kwargs)
+    cache = TSECache(settings=settings)
+    cache.instruments = pd.read_csv("sample_data/instruments.csv", index_col="InsCode")
+    cache.splits = pd.read_csv("sample_data/shares.csv", index_col=["InsCode", "DEven"])
+    codes = [35796086458096255, 71483646978964608, 9211775239375291]
+    cache.add_to_prices(
+        [
+            pd.read_csv(
+                f"sample_data/prices_not_adj/{str(code)}.csv",
+                index_col=["InsCode", "DEven"],
+            ).drop(columns="Symbol")
+            for code in codes
+        ]
+    )
+    return cache
+
+
+def test_adjusted_prices_cache(mocker, tmp_path: Path):
+    """
+    test reusing adjusted prices until prices of a symbol change
+    """
+
+    cache = _adjusted_cache(tmp_path, cache_to_db=False)
+    spy = mocker.spy(cache_manager, "adjust_prices")
+    symbols = ["شیران", "ذوب"]
+    first = cache.prices_by_symbol(symbols, ["AdjPClosing"])
+    assert spy.call_count == 1
+    second = cache.prices_by_symbol(symbols, ["AdjPClosing"])
+    assert spy.call_count == 1
+    for symbol in symbols:
+        pd.testing.assert_frame_equal(first[symbol], second[symbol])
+
+    # only the symbol with a new row is adjusted again
+    new_row = cache.prices.loc[[35796086458096255]].iloc[-1:].reset_index()
+    new_row["DEven"] = 30000101
+    cache.add_to_prices([new_row.set_index(["InsCode", "DEven"])])
+    cache.prices_by_symbol(symbols, ["AdjPClosing"])
+    assert spy.call_count == 2
+    assert set(spy.call_args.kwargs["groups"]) == {"شیران"}
+
+    # a corrected price without new rows is adjusted again too
+    fixed_row = cache.prices.loc[[71483646978964608]].iloc[-1:].copy()
+    fixed_row["PClosing"] += 1
+    cache.add_to_prices([fixed_row])
+    cache.prices_by_symbol(symbols, ["AdjPClosing"])
+    assert spy.call_count == 3
+    assert set(spy.call_args.kwargs["groups"]) == {"ذوب"}
+
+
+def test_persist_adjusted_prices(mocker, tmp_path: Path):
+    """
+    test loading adjusted prices persisted by another cache instance
+    """
+
+    cache = _adjusted_cache(tmp_path, cache_to_db=True, persist_adjusted=True)
+    expected = cache.prices_by_symbol(["ذوب"], ["AdjPClosing"])
+    cache = _adjusted_cache(tmp_path, cache_to_db=True, persist_adjusted=True)
+    spy = mocker.spy(cache_manager, "adjust_prices")
+    res = cache.prices_by_symbol(["ذوب"], ["AdjPClosing"])
+    assert spy.call_count == 0
+    pd.testing.assert_frame_equal(res["ذوب"], expected["ذوب"])
+
+    # stored series of corrected prices are not used
+    cache = _adjusted_cache(tmp_path, cache_to_db=True, persist_adjusted=True)
+    fixed_row = cache.prices.loc[[71483646978964608]].iloc[-1:].copy()
+    fixed_row["PClosing"] += 1
+    cache.add_to_prices([fixed_row])
+    cache.prices_by_symbol(["ذوب"], ["AdjPClosing"])
+    assert spy.call_count == 1
+
+
+def test_read_adjusted_sorted(tmp_path: Path):
+    """
+    test stored adjusted prices are read sorted by date
+    """
+
+    engine = create_engine("sqlite:///" + str(tmp_path / "test.db"))
+    db = SQLiteStorage(engine)
+    data = pd.DataFrame(
+        {
+            "Symbol": "a",
+            "InsCode": [2, 1, 1, 2],
+            "DEven": [20240102, 20240103, 20240101, 20240101],
+            "AdjPClosing": [1, 2, 3, 4],
+        }
+    )
+    db.write_adjusted(1, "1,2", "v1", data)
+    version, res = db.read_adjusted(1, "1,2")
+    assert version == "v1"
+    expected = data.sort_values(["DEven", "InsCode"], ignore_index=True)
+    pd.testing.assert_frame_equal(res, expected)
+
+
+def test_symbol_index(tmp_path: Path):
+    """
+    test mapping symbols to codes and building the index again after a merge
+    """
+
+    cache = _adjusted_cache(tmp_path, cache_to_db=False)
+    index = cache.symbol_index
+    assert sorted(index["ذوب"]) == [9211775239375291, 71483646978964608]
+    assert cache.symbol_index is index
+    new_instrument = cache.instruments.loc[[35796086458096255]].copy()
+    new_instrument.index = pd.Index([1], name="InsCode")
+    cache.merge_instruments(new_instrument)
+    assert sorted(cache.symbol_index["شیران"]) == [1, 35796086458096255]
+
+    res = cache.prices_by_symbol(["ذوب", "شیران", "missing", "ذوب"], ["AdjPClosing"])
+    assert list(res) == sorted(["ذوب", "شیران"])
+    for data in res.values():
+        assert data.index.is_monotonic_increasing
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+def test_merge_instruments(tmp_path: Path, backend: str):
+    """
+    test upserting changed instruments and splits and logging the changes
+    """
+
+    if backend == "parquet":
+        pytest.importorskip("pyarrow")
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    settings["storage_backend"] = backend
+    instruments = pd.read_csv("sample_data/instruments.csv", index_col="InsCode")
+    splits = pd.read_csv("sample_data/shares.csv", index_col=["InsCode", "DEven"])
+    cache = TSECache(settings=settings)
+    changes = cache.merge_instruments(instruments.iloc[:100])
+    assert len(changes) == 100
+    cache.merge_splits(splits)
+    cache.instruments_to_db()
+
+    cache = TSECache(settings=settings)
+    delta = instruments.iloc[90:110].copy()
+    changed_code = delta.index[0]
+    delta.loc[changed_code, "Name"] = "changed"
+    changes = cache.merge_instruments(delta)
+    assert cache.merge_splits(splits.iloc[-10:]).empty
+    assert sorted(changes["Change"].value_counts().items()) == [
+        ("insert", 10),
+        ("update", 1),
+    ]
+    cache.instruments_to_db()
+
+    cache = TSECache(settings=settings)
+    expected = instruments.iloc[:110].copy()
+    expected.loc[changed_code, "Name"] = "changed"
+    pd.testing.assert_frame_equal(
+        cache.instruments.sort_index(), expected.sort_index(), check_dtype=False
+    )
+    assert len(cache.splits) == len(splits)
+    change_log = cache.read_change_log()
+    updates = change_log[change_log["Change"] == "update"]
+    assert list(updates.index.get_level_values("InsCode")) == [changed_code]
+    assert len(change_log.xs("splits", level="Table")) == len(
+        splits.index.drop_duplicates()
+    )
+    assert cache.read_change_log(since=30000101).empty
+
+
+def test_lazy_loading(mocker, tmp_path: Path):
+    """
+    test reading tables on first access and inspecting the database once
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    cache.instruments = pd.read_csv("sample_data/instruments.csv", index_col="InsCode")
+    cache.last_possible_deven = "20230815"
+    cache.instruments_to_db()
+
+    read_table = mocker.spy(SQLiteStorage, "read_table")
+    inspect_db = mocker.spy(storage, "inspect")
+    cache = TSECache(settings=settings)
+    assert read_table.call_count == 0
+    assert cache.last_possible_deven == "20230815"
+    assert [call.kwargs["table_name"] for call in read_table.call_args_list] == [
+        "metadata"
+    ]
+    assert len(cache.instruments) > 0
+    assert cache.splits is None
+    assert cache.instruments is not None
+    assert read_table.call_count == 3
+    assert inspect_db.call_count == 1
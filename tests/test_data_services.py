@@ -48,6 +48,33 @@ def test_should_update(last_update, last_possible_update, expected):
     assert res == expected
 
 
+@pytest.mark.parametrize(
+    "now",
+    [
+        datetime.datetime(2022, 3, 2, 10),
+        datetime.datetime(2022, 3, 2, 18),
+        datetime.datetime(2022, 3, 3, 10),
+        datetime.datetime(2022, 3, 5, 10),
+    ],
+)
+def test_should_update_many(mocker, now):
+    """
+    Test should_update_many gives the same result as should_update.
+    """
+
+    mock_date = mocker.patch("dtse.data_services.datetime", wraps=datetime.datetime)
+    mock_date.now.return_value = now
+    devens = pd.Series(
+        [0, 20220101, 20220224, 20220226, 20220227, 20220301, 20220302, 20220303]
+    )
+    for last_possible in ["20220223", "20220227", "20220302", ""]:
+        expected = [
+            data_services.should_update(str(deven), last_possible) for deven in devens
+        ]
+        res = data_services.should_update_many(devens, last_possible)
+        assert res.to_list() == expected
+
+
 @pytest.mark.vcr()
 async def test_get_last_possible_deven(test_cache):
     """
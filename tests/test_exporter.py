@@ -0,0 +1,106 @@
+"""test exporter.py"""
+
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from dtse import exporter
+from dtse.exporter import PriceExporter, export_file, export_path
+
+
+@pytest.fixture(name="prices")
+def fixture_prices() -> dict:
+    """
+    prices of two symbols indexed by symbol and date like TSECache.prices_by_symbol
+    """
+
+    prices = {}
+    for sym, code in {"ذوب": 71483646978964608, "شیران": 35796086458096255}.items():
+        data = pd.read_csv(f"sample_data/prices_not_adj/{code}.csv")
+        data["Symbol"] = sym
+        prices[sym] = data.set_index(["Symbol", "DEven"])[
+            ["PClosing", "PriceYesterday", "ZTotTran"]
+        ].iloc[-100:]
+    return prices
+
+
+def test_export_csv_appends_new_rows(prices: dict, tmp_path: Path):
+    """
+    test only rows after the last exported row are written
+    """
+
+    exporter = PriceExporter(tmp_path, threads=2)
+    old = {sym: data.iloc[:-3] for sym, data in prices.items()}
+    assert exporter.export(old) == {sym: 97 for sym in prices}
+    path = export_path(tmp_path, "ذوب")
+    size = path.stat().st_size
+
+    assert exporter.export(prices) == {sym: 3 for sym in prices}
+    assert exporter.export(prices) == {sym: 0 for sym in prices}
+    with open(path, "rb") as file:
+        file.seek(size)
+        assert file.read().decode("utf-8").count("\n") == 3
+    for sym, data in prices.items():
+        res = pd.read_csv(export_path(tmp_path, sym), index_col=["Symbol", "DEven"])
+        pd.testing.assert_frame_equal(res, data)
+
+
+def test_export_csv_rewrites_changed_rows(prices: dict, tmp_path: Path):
+    """
+    test a file is replaced when its stored rows changed (e.g. adjusted again)
+    """
+
+    data = prices["ذوب"]
+    path = export_path(tmp_path, "ذوب")
+    export_file(data.iloc[:-1], path)
+    changed = data.copy()
+    changed["PClosing"] = changed["PClosing"] * 2
+    assert export_file(changed, path) == len(changed)
+    res = pd.read_csv(path, index_col=["Symbol", "DEven"])
+    pd.testing.assert_frame_equal(res, changed)
+    assert [file.name for file in tmp_path.iterdir()] == [path.name]
+
+
+@pytest.mark.parametrize("file_format", ["csv.gz", "parquet", "feather"])
+def test_export_formats(prices: dict, tmp_path: Path, file_format: str):
+    """
+    test exporting in other file formats
+    """
+
+    if file_format != "csv.gz":
+        pytest.importorskip("pyarrow")
+    data = prices["شیران"]
+    path = export_path(tmp_path, "شیران", file_format)
+    assert export_file(data.iloc[:-2], path, file_format) == len(data) - 2
+    expected_count = 2 if file_format == "csv.gz" else len(data)
+    assert export_file(data, path, file_format) == expected_count
+    assert export_file(data, path, file_format) == 0
+    if file_format == "csv.gz":
+        res = pd.read_csv(path, index_col=["Symbol", "DEven"])
+    elif file_format == "parquet":
+        res = pd.read_parquet(path)
+    else:
+        res = pd.read_feather(path).set_index(["Symbol", "DEven"])
+    pd.testing.assert_frame_equal(res, data)
+
+
+def test_export_csv_gz_tail(prices: dict, tmp_path: Path, monkeypatch):
+    """
+    test csv.gz files are not decompressed to find their last row
+    """
+
+    data = prices["ذوب"]
+    path = export_path(tmp_path, "ذوب", "csv.gz")
+    export_file(data.iloc[:-5], path, "csv.gz")
+    with monkeypatch.context() as patch:
+        patch.setattr(exporter.gzip, "open", None)
+        assert export_file(data.iloc[:-2], path, "csv.gz") == 3
+    # a stale sidecar is not used
+    tail_path = path.with_name(f"{path.name}.tail")
+    tail = tail_path.read_text(encoding="utf-8")
+    export_file(data.iloc[:-1], path, "csv.gz")
+    tail_path.write_text(tail, encoding="utf-8")
+    assert export_file(data, path, "csv.gz") == 1
+    res = pd.read_csv(path, index_col=["Symbol", "DEven"])
+    pd.testing.assert_frame_equal(res, data)
@@ -0,0 +1,118 @@
+"""test parallel.py"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dtse import config as cfg
+from dtse.parallel import MappedFrame, adjust_prices_parallel, write_files_parallel
+from dtse.price_adjuster import adjust_prices
+
+symbol_codes = {
+    "ذوب": [71483646978964608, 9211775239375291],
+    "شیران": [35796086458096255],
+    "همراه": [26787658273107220, 68635710163497089],
+    "فولاد": [46348559193224090],
+}
+
+
+@pytest.fixture(name="prices", scope="module")
+def fixture_prices() -> pd.DataFrame:
+    """
+    prices of the sample symbols
+    """
+
+    return pd.concat(
+        [
+            pd.read_csv(
+                f"sample_data/prices_not_adj/{str(code)}.csv",
+                index_col=["InsCode", "DEven"],
+            ).drop(columns="Symbol")
+            for codes in symbol_codes.values()
+            for code in codes
+        ]
+    ).sort_index()
+
+
+def test_mapped_frame(prices: pd.DataFrame):
+    """
+    test reading rows of a memory-mapped frame
+    """
+
+    data = prices.reset_index()
+    data["Symbol"] = "x"
+    with MappedFrame(data) as mapped:
+        assert "Symbol" not in mapped.columns
+        rows = np.asarray(data["InsCode"] == 35796086458096255)
+        res = MappedFrame.read(mapped.spec, rows)
+        path = Path(mapped.spec[0])
+        assert path.is_dir()
+    assert not path.exists()
+    expected = data.loc[rows, mapped.columns].reset_index(drop=True)
+    pd.testing.assert_frame_equal(res, expected)
+    with MappedFrame(data, strings=True) as mapped:
+        res = MappedFrame.read(mapped.spec, np.flatnonzero(rows))
+    pd.testing.assert_frame_equal(res, data[rows].reset_index(drop=True))
+
+    # nullable numbers keep missing values
+    data["PriceFirst"] = data["PriceFirst"].astype("Int64").mask(~rows)
+    with MappedFrame(data) as mapped:
+        res = MappedFrame.read(mapped.spec)
+    pd.testing.assert_frame_equal(res, data[mapped.columns])
+    data["Symbol"] = data["Symbol"].where(rows)
+    with pytest.raises(TypeError, match="Symbol"):
+        MappedFrame(data, strings=True)
+
+
+@pytest.mark.parametrize("cond", [1, 2])
+def test_adjust_prices_parallel(prices: pd.DataFrame, cond: int):
+    """
+    test adjusting in worker processes gives the same result as in one process
+    """
+
+    splits = pd.read_csv("sample_data/shares.csv", index_col=["InsCode", "DEven"])
+    groups = pd.Series(
+        {code: sym for sym, codes in symbol_codes.items() for code in codes},
+        name="Symbol",
+    )
+    nominal_prices = cfg.storage["NOMINAL_PRICES"]
+    expected = adjust_prices(prices, groups, cond, splits, nominal_prices)
+    res = adjust_prices_parallel(
+        prices, groups, cond, splits, nominal_prices, workers=2
+    )
+    pd.testing.assert_frame_equal(res, expected)
+
+
+def test_write_files_parallel(prices: pd.DataFrame, tmp_path: Path):
+    """
+    test writing a file for each symbol in worker processes
+    """
+
+    data = {
+        sym: prices.loc[codes].iloc[-50:].assign(Name=sym)
+        for sym, codes in symbol_codes.items()
+    }
+    data["empty"] = prices.iloc[:0]
+    write_files_parallel(data, tmp_path, workers=2)
+    assert sorted(path.stem for path in tmp_path.iterdir()) == sorted(symbol_codes)
+    for sym, codes in symbol_codes.items():
+        res = pd.read_csv(tmp_path / f"{sym}.csv", index_col=["InsCode", "DEven"])
+        pd.testing.assert_frame_equal(res, data[sym], check_dtype=False)
+
+
+def test_write_files_parallel_missing_strings(prices: pd.DataFrame, tmp_path: Path):
+    """
+    test strings with missing values are written like by one process
+    """
+
+    data = {
+        sym: prices.loc[codes].iloc[-5:].assign(Name=[sym, None, sym, sym, sym])
+        for sym, codes in symbol_codes.items()
+    }
+    write_files_parallel(data, tmp_path, workers=2)
+    for sym in symbol_codes:
+        res = pd.read_csv(tmp_path / f"{sym}.csv", index_col=["InsCode", "DEven"])
+        assert res["Name"].isna().tolist() == [False, True, False, False, False]
+        pd.testing.assert_frame_equal(res, data[sym], check_dtype=False)
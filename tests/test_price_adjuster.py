@@ -0,0 +1,95 @@
+"""test price_adjuster.py"""
+
+import pandas as pd
+import pytest
+
+from dtse import config as cfg
+from dtse.price_adjuster import adjust_prices
+from dtse.tse_utils import to_prices_dtypes
+
+symbol_codes = {
+    "ذوب": [71483646978964608, 9211775239375291],
+    "شیران": [35796086458096255],
+    "همراه": [26787658273107220, 68635710163497089],
+}
+
+
+@pytest.mark.parametrize("cond", [0, 1, 2, 3])
+def test_adjust_prices_by_group(cond):
+    """
+    test adjusting many symbols at once gives the same result as one by one
+    """
+
+    prices = pd.concat(
+        [
+            pd.read_csv(
+                f"sample_data/prices_not_adj/{str(code)}.csv",
+                index_col=["InsCode", "DEven"],
+            ).drop(columns="Symbol")
+            for codes in symbol_codes.values()
+            for code in codes
+        ]
+    )
+    splits = pd.read_csv("sample_data/shares.csv", index_col=["InsCode", "DEven"])
+    groups = pd.Series(
+        {code: sym for sym, codes in symbol_codes.items() for code in codes},
+        name="Symbol",
+    )
+    nominal_prices = cfg.storage["NOMINAL_PRICES"]
+    res = adjust_prices(prices, groups, cond, splits, nominal_prices)
+    assert list(res["Symbol"].unique()) == sorted(symbol_codes)
+    for sym, codes in symbol_codes.items():
+        sym_prices = prices[prices.index.isin(codes, level="InsCode")]
+        exp_res = adjust_prices(
+            sym_prices, groups[groups == sym], cond, splits, nominal_prices
+        )
+        pd.testing.assert_frame_equal(
+            res[res["Symbol"] == sym].reset_index(drop=True), exp_res
+        )
+
+
+def test_nominal_prices_after_market_moves():
+    """
+    test fixing nominal prices of a stock that moved between markets twice
+    """
+
+    cols = ["InsCode", "DEven", "PClosing", "PriceYesterday", "QTotTran5J"]
+    prices = pd.DataFrame(
+        [
+            [1, 20200101, 100, 90, 10],
+            [1, 20200102, 110, 100, 10],
+            [2, 20200103, 1000, 1000, 0],
+            [2, 20200104, 1000, 1000, 0],
+            [2, 20200105, 120, 1000, 5],
+            [2, 20200106, 125, 120, 5],
+            [3, 20200107, 1000, 1000, 5],
+            [3, 20200108, 130, 1000, 5],
+        ],
+        columns=cols,
+        dtype=float,
+    ).astype({"InsCode": int, "DEven": int})
+    prices = prices.set_index(["InsCode", "DEven"])
+    groups = pd.Series("sym", index=[1, 2, 3], name="Symbol")
+    res = adjust_prices(prices, groups, 0, nominal_prices=[1000, 0])
+    assert res["PClosing"].to_list() == [100, 110, 110, 110, 120, 125, 1000, 130]
+    assert res["PriceYesterday"].to_list() == [90, 100, 110, 110, 110, 120, 125, 1000]
+
+
+def test_missing_prices():
+    """
+    test missing prices don't change other adjusted prices
+    """
+
+    prices = pd.DataFrame(
+        {
+            "InsCode": 1,
+            "DEven": [20200101, 20200102, 20200103, 20200104],
+            "PClosing": [100, 110, None, 120],
+            "PriceYesterday": [90, None, 110, 120],
+            "QTotTran5J": 1,
+        }
+    )
+    prices = to_prices_dtypes(prices).set_index(["InsCode", "DEven"])
+    groups = pd.Series("sym", index=[1], name="Symbol")
+    res = adjust_prices(prices, groups, 1)
+    assert res["AdjPClosing"].to_list() == [100, 110, pd.NA, 120]
@@ -1,6 +1,8 @@
 """
 test price_update_helper
 """
+
+import asyncio
 import json
 from collections.abc import Generator
 from pathlib import Path
@@ -11,7 +13,8 @@ import pytest
 from dtse import config as cfg
 from dtse.cache_manager import TSECache
 from dtse.data_services import update_instruments
-from dtse.price_updater import PriceUpdater
+from dtse.price_updater import AdaptiveLimiter, PriceUpdater
+from dtse.tse_request import TSERequest
 
 
 @pytest.fixture(name="test_catch")
@@ -66,3 +69,267 @@ async def test_start(resp_data, test_catch):
     ).set_index("InsCode")
     ret_val = await pu_helper.update_prices(outdated_insts=outdated_insts)
     assert set(["succs", "fails"]) == set(ret_val)
+
+
+async def test_limiter_bounds_in_flight():
+    """
+    test AdaptiveLimiter never exceeds its limit
+    """
+
+    limiter = AdaptiveLimiter(initial=3, maximum=3, min_interval=0)
+    peak = 0
+
+    async def job():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[job() for _ in range(20)])
+    assert peak == 3
+    assert limiter.in_flight == 0
+
+
+async def test_limiter_aimd():
+    """
+    test AdaptiveLimiter grows on success and shrinks on errors or slow responses
+    """
+
+    limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=8, target_latency=1)
+    await limiter.acquire()
+    await limiter.release(latency=0.1)
+    assert limiter.limit == 4.25
+    await limiter.acquire()
+    await limiter.release(latency=0.1, failed=True)
+    assert limiter.limit == 2.125
+    await limiter.acquire()
+    await limiter.release(latency=2)
+    assert limiter.limit == 1.0625
+    await limiter.acquire()
+    await limiter.release(latency=2)
+    assert limiter.limit == 1
+
+
+async def test_limiter_backoff_once_per_window():
+    """
+    test failures of concurrent requests shrink the limit only once
+    """
+
+    limiter = AdaptiveLimiter(initial=8, minimum=1, maximum=8, min_interval=0)
+    windows = [await limiter.acquire() for _ in range(4)]
+    for window in windows:
+        await limiter.release(latency=0.1, failed=True, window=window)
+    assert limiter.limit == 4
+    # a request started after the back off starts a new window
+    window = await limiter.acquire()
+    await limiter.release(latency=0.1, failed=True, window=window)
+    assert limiter.limit == 2
+
+
+def test_limiter_settings(monkeypatch, tmp_path: Path):
+    """
+    test limiter settings are read from the config when used, or given
+    """
+
+    monkeypatch.setattr(cfg, "PRICES_UPDATE_CHUNK_DELAY", 0)
+    assert AdaptiveLimiter().min_interval == 0
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": False, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    assert PriceUpdater(cache)._limiter.min_interval == 0
+    cache.settings["price_requests"] = {"min_interval": 2, "maximum": 3}
+    assert PriceUpdater(cache)._limiter.min_interval == 2
+    limiter = PriceUpdater(cache, limiter={"initial": 8})._limiter
+    assert (limiter.limit, limiter.min_interval) == (8, 0)
+
+
+async def test_limiter_rate():
+    """
+    test AdaptiveLimiter spaces out request starts
+    """
+
+    limiter = AdaptiveLimiter(initial=4, min_interval=0.05)
+    loop = asyncio.get_running_loop()
+    starts = []
+
+    async def job():
+        async with limiter.slot():
+            starts.append(loop.time())
+
+    await asyncio.gather(*[job() for _ in range(4)])
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    assert min(gaps) >= 0.04
+
+
+class _FakeClient:
+    # closing prices client that fails for a code, like a lost connection
+
+    is_open = True
+
+    def __init__(self, fail_code: int | None = None) -> None:
+        self.fail_code = fail_code
+        self.requested: list[list[int]] = []
+
+    async def closing_prices(self, req_param: str) -> str:
+        codes = [int(row.split(",")[0]) for row in req_param.split(";")]
+        self.requested.append(codes)
+        if self.fail_code in codes:
+            raise RuntimeError("connection lost")
+        # no new prices for any of the codes
+        return "@" * (len(codes) - 1)
+
+
+async def test_retry_lost_connection(monkeypatch, tmp_path: Path):
+    """
+    test a request is retried when the server closes the connection
+    """
+
+    monkeypatch.setattr(cfg, "PRICES_UPDATE_RETRY_DELAY", 0)
+    n_connections = 0
+
+    async def handle(reader, writer):
+        # close the first connections without a response. aiohttp itself
+        # sends a request again once after a lost connection.
+        nonlocal n_connections
+        n_connections += 1
+        await reader.readuntil(b"\r\n\r\n")
+        if n_connections > 2:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                b"Content-Length: 1\r\n\r\n@"
+            )
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    settings = dict(cfg.storage)
+    settings.update(
+        {
+            "cache_to_db": False,
+            "tse_dir": tmp_path,
+            "price_requests": {"min_interval": 0},
+        }
+    )
+    updater = PriceUpdater(
+        TSECache(settings=settings), TSERequest(api_url=f"http://127.0.0.1:{port}/")
+    )
+    async with server:
+        res = await updater.update_prices(
+            outdated_insts=pd.DataFrame(
+                {"DEven": 20200101, "NotInNoMarket": 1}, index=pd.Index([1, 2])
+            )
+        )
+    assert n_connections == 3
+    assert sorted(res["succs"]) == [1, 2]
+
+
+async def test_resume_update(monkeypatch, tmp_path: Path):
+    """
+    test an interrupted update is journaled and resumed where it stopped
+    """
+
+    monkeypatch.setattr(cfg, "PRICES_UPDATE_CHUNK", 2)
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    outdated = pd.DataFrame(
+        {"DEven": 20200101, "NotInNoMarket": 1}, index=pd.Index(range(1, 7))
+    )
+
+    client = _FakeClient(fail_code=6)
+    updater = PriceUpdater(
+        TSECache(settings=settings),
+        tse_req=client,
+        limiter={"initial": 1, "maximum": 1, "min_interval": 0},
+    )
+    with pytest.raises(RuntimeError):
+        await updater.update_prices(outdated_insts=outdated)
+
+    cache = TSECache(settings=settings)
+    assert cache.price_jobs["Status"].to_dict() == {
+        1: cfg.JOB_DONE,
+        2: cfg.JOB_DONE,
+        3: cfg.JOB_DONE,
+        4: cfg.JOB_DONE,
+        5: cfg.JOB_FAILED,
+        6: cfg.JOB_FAILED,
+    }
+    client = _FakeClient()
+    updater = PriceUpdater(cache, tse_req=client)
+    res = await updater.update_prices(outdated_insts=outdated.loc[[1]])
+    assert client.requested == [[5, 6], [1]]
+    assert sorted(res["succs"]) == [1, 5, 6]
+    assert set(TSECache(settings=settings).price_jobs["Status"]) == {cfg.JOB_DONE}
+
+
+async def test_drop_failing_jobs(tmp_path: Path):
+    """
+    test unfinished jobs are not resumed after too many attempts
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": True, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    max_attempts = cfg.PRICES_UPDATE_MAX_ATTEMPTS
+    cache.set_price_jobs(
+        pd.DataFrame(
+            {
+                "Chunk": 0,
+                "DEven": 20200101,
+                "NotInNoMarket": 1,
+                "Status": [cfg.JOB_FAILED, cfg.JOB_PENDING, cfg.JOB_FAILED],
+                "Attempts": [max_attempts, max_attempts - 1, max_attempts],
+            },
+            index=pd.Index([1, 2, 3], name="InsCode"),
+        )
+    )
+
+    client = _FakeClient()
+    updater = PriceUpdater(cache, tse_req=client)
+    res = await updater.update_prices(
+        outdated_insts=pd.DataFrame(
+            {"DEven": 20200101, "NotInNoMarket": 1}, index=pd.Index([3, 4])
+        )
+    )
+    # a requested code is downloaded even after many attempts
+    assert sorted(res["succs"]) == [2, 3, 4]
+    jobs = TSECache(settings=settings).price_jobs
+    assert jobs["Status"].to_dict() == {
+        1: cfg.JOB_DROPPED,
+        2: cfg.JOB_DONE,
+        3: cfg.JOB_DONE,
+        4: cfg.JOB_DONE,
+    }
+    assert jobs["Attempts"].to_dict() == {
+        1: max_attempts,
+        2: max_attempts,
+        3: max_attempts + 1,
+        4: 1,
+    }
+
+
+async def test_skip_current_codes(tmp_path: Path):
+    """
+    test codes without new sessions are not requested
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": False, "tse_dir": tmp_path})
+    cache = TSECache(settings=settings)
+    # a tuesday, the day before was a session
+    cache.last_possible_deven = "20240319"
+    client = _FakeClient()
+    updater = PriceUpdater(cache, tse_req=client)
+    res = await updater.update_prices(
+        outdated_insts=pd.DataFrame(
+            {"DEven": [20240319, 20240318, 0], "NotInNoMarket": 1},
+            index=pd.Index([1, 2, 3]),
+        )
+    )
+    assert client.requested == [[2, 3]]
+    assert sorted(res["succs"]) == [2, 3]
+    assert cache.price_jobs["Status"].to_dict() == dict.fromkeys(
+        [1, 2, 3], cfg.JOB_DONE
+    )
+    assert cache.price_jobs["Chunk"].to_dict() == {1: -1, 2: 0, 3: 0}
+    assert list(cache.last_devens.index) == [1, 2, 3]
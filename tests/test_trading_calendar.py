@@ -0,0 +1,74 @@
+"""test trading_calendar.py"""
+
+from pathlib import Path
+
+import pandas as pd
+
+from dtse import config as cfg
+from dtse.cache_manager import TSECache
+from dtse.trading_calendar import TradingCalendar
+
+
+def test_sessions():
+    """
+    test weekends, fixed solar holidays, other holidays and learned sessions
+    """
+
+    calendar = TradingCalendar(holidays=[20240402])
+    # 1402/12/29, nowruz and 1403/01/12-13 are holidays
+    assert calendar.sessions(20240316, 20240407).tolist() == [
+        20240316,
+        20240317,
+        20240318,
+        20240324,
+        20240325,
+        20240326,
+        20240327,
+        20240330,
+        20240403,
+        20240406,
+        20240407,
+    ]
+    # a thursday with prices
+    calendar.add_sessions([20240328])
+    assert calendar.missing_sessions(20240327, 20240330).tolist() == [
+        20240328,
+        20240330,
+    ]
+    assert calendar.missing_sessions(20240330, 20240330).size == 0
+
+
+def test_count_missing():
+    """
+    test counting sessions after many dates at once
+    """
+
+    calendar = TradingCalendar()
+    since = pd.Series([20240301, 20240315, 20240320, 20240410, 0], dtype="Int64")
+    res = calendar.count_missing(since, 20240405)
+    expected = [len(calendar.missing_sessions(deven, 20240405)) for deven in since[:-1]]
+    assert res.tolist()[:-1] == expected
+    assert res.iloc[-2] == 0
+
+
+def test_cache_calendars(tmp_path: Path):
+    """
+    test prices of a cache only add sessions to the calendar of that cache
+    """
+
+    settings = dict(cfg.storage)
+    settings.update({"cache_to_db": False, "tse_dir": tmp_path})
+    cache, other_cache = TSECache(settings=settings), TSECache(settings=settings)
+    # a thursday with prices
+    new_prices = pd.DataFrame(
+        {"PClosing": [1]},
+        index=pd.MultiIndex.from_tuples([(1, 20240328)], names=["InsCode", "DEven"]),
+    )
+    cache.add_to_prices([new_prices])
+    assert cache.calendar.missing_sessions(20240327, 20240330).tolist() == [
+        20240328,
+        20240330,
+    ]
+    assert other_cache.calendar.missing_sessions(20240327, 20240330).tolist() == [
+        20240330
+    ]
@@ -1,7 +1,9 @@
 """test tse_data.py"""
 
 import logging
+from pathlib import Path
 
+import pandas as pd
 import pytest
 
 from dtse.tse_data import TSE
@@ -58,3 +60,49 @@ async def test_get_prices_integ():
     get_prices = TSE().get_prices(symbols=["همراه"])
     prices = await get_prices
     assert prices != "OK"
+
+
+@pytest.mark.parametrize("session, n_updates", [(True, 1), (False, 2)])
+async def test_session(mocker, tmp_path: Path, session: bool, n_updates: int):
+    """
+    test reusing the cache and freshness checks between calls of a session
+    """
+
+    instruments = pd.read_csv("sample_data/instruments.csv", index_col="InsCode")
+
+    async def update_instruments(cache, tse_req):
+        cache.instruments = instruments
+
+    async def update_prices(self, outdated_insts):
+        codes = outdated_insts.index.to_list()
+        self._cache.add_to_prices(
+            [
+                pd.read_csv(
+                    f"sample_data/prices_not_adj/{str(code)}.csv",
+                    index_col=["InsCode", "DEven"],
+                ).drop(columns="Symbol")
+                for code in codes
+            ]
+        )
+        return {"succs": codes, "fails": []}
+
+    upd_ins = mocker.patch(
+        "dtse.tse_data.data_svs.update_instruments", side_effect=update_instruments
+    )
+    upd_prc = mocker.patch(
+        "dtse.tse_data.PriceUpdater.update_prices",
+        side_effect=update_prices,
+        autospec=True,
+    )
+    settings = {"cache_to_db": False, "write_csv": False, "tse_dir": tmp_path}
+    async with TSE(session=session) as tse:
+        first = await tse.get_prices(["ذوب"], **settings)
+        second = await tse.get_prices(["ذوب"], **settings)
+        assert upd_ins.call_count == n_updates
+        assert upd_prc.call_count == n_updates
+        pd.testing.assert_frame_equal(first["ذوب"], second["ذوب"])
+        if session:
+            # only codes of the new symbol are checked
+            await tse.get_prices(["ذوب", "شیران"], **settings)
+            outdated = upd_prc.call_args.kwargs["outdated_insts"]
+            assert outdated.index.to_list() == [35796086458096255]
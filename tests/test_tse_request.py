@@ -62,3 +62,21 @@ async def test_instrument_and_share():
     assert splits.empty is not True
     assert len(splits.columns) == 5
     assert len(splits.index) > 100
+
+
+async def test_shared_session(vcr):
+    """
+    test reusing one pooled session inside the context manager
+    """
+
+    pattern = re.compile(r"^\d{8};\d{8}$")
+    async with TSERequest(pool={"limit_per_host": 2}) as instance:
+        assert instance.is_open
+        session = instance._session
+        assert session.connector.limit_per_host == 2
+        with vcr.use_cassette("test_last_possible_deven.yaml"):
+            resp = await instance.last_possible_deven()
+        assert instance._session is session
+    assert pattern.match(resp)
+    assert not instance.is_open
+    assert session.closed
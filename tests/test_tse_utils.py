@@ -1,7 +1,9 @@
 """test tse_utils.py"""
 
+import pandas as pd
 import pytest
 
+from dtse import config as cfg
 from dtse import tse_utils
 
 # TODO: use given https://hypothesis.readthedocs.io/en/latest/quickstart.html
@@ -28,3 +30,103 @@ def test_clean_fa(text_res):
 
     with pytest.raises(TypeError):
         tse_utils.clean_fa(12345)
+
+
+def test_clean_fa_series():
+    """
+    test clean_fa_series
+    """
+
+    texts = pd.Series([text for text, _ in sample_texts] + [None])
+    res = tse_utils.clean_fa_series(texts)
+    assert list(res.iloc[:-1]) == [exp_res for _, exp_res in sample_texts]
+    assert pd.isna(res.iloc[-1])
+
+
+def test_parse_closing_prices():
+    """
+    test parse_closing_prices
+    """
+
+    rows = [
+        "1,20220326,13890.00,13910.00,0,0,0.00,0.00,0.00,13890.00,0.00",
+        "1,20220327,13900.00,13910.00,3,100,1390000.00,13800.00,14000.00,13890.00,13850.00",
+        "2,20220326,500.00,510.00,1,10,5000.00,490.00,510.00,495.00,500.00",
+    ]
+    response = ";".join(rows[:2]) + "@@" + rows[2]
+    res = tse_utils.parse_closing_prices(response, n_codes=3)
+    assert list(res.index.names) == ["InsCode", "DEven"]
+    assert list(res.index) == [(1, 20220326), (1, 20220327), (2, 20220326)]
+    assert res.loc[(1, 20220327), "QTotTran5J"] == 100
+    assert res.loc[(2, 20220326), "PriceFirst"] == 500
+    assert res.index.levels[1].dtype == "int32"
+    assert res["PClosing"].dtype == "int64"
+
+    empty = tse_utils.parse_closing_prices("@", n_codes=2)
+    assert empty.empty
+    assert list(empty.index.names) == ["InsCode", "DEven"]
+
+    with pytest.raises(ValueError):
+        tse_utils.parse_closing_prices(response, n_codes=2)
+
+
+@pytest.fixture(name="jalali_cache")
+def fixture_jalali_cache():
+    """
+    start with an empty cache of converted dates
+    """
+
+    tse_utils._to_jalali.cache_clear()
+    yield
+    tse_utils._to_jalali.cache_clear()
+
+
+def test_to_jalali_dates(jalali_cache):
+    """
+    test converting many dates and reusing converted ones
+    """
+
+    assert tse_utils.to_jalali_date("20220321") == "1401/01/01"
+    assert tse_utils.to_jalali_date(20200526) == "1399/03/06"
+    dates = [20220321, 20200526, 20220321, 20230320]
+    res = tse_utils.to_jalali_dates(dates)
+    assert list(res) == ["1401/01/01", "1399/03/06", "1401/01/01", "1401/12/29"]
+    assert len(tse_utils.to_jalali_dates([])) == 0
+
+    known = {10000101: "fake"}
+    res = tse_utils.to_jalali_dates([10000101, 20230320], known)
+    assert list(res) == ["fake", "1401/12/29"]
+    assert known[20230320] == "1401/12/29"
+    assert tse_utils._to_jalali.cache_info().hits >= 2
+
+
+def test_to_prices_dtypes():
+    """
+    test compact dtypes of prices, keeping missing values and rejecting values
+    that don't fit
+    """
+
+    prices = pd.DataFrame(
+        {
+            "DEven": [20220326, 20220327],
+            "PClosing": [13890.0, 13900.0],
+            "PriceMin": [13890.0, 3e9],
+            "PriceFirst": [13890.0, None],
+            "ZTotTran": [0, 3],
+            "Symbol": ["a", "b"],
+        }
+    )
+    res = tse_utils.to_prices_dtypes(prices)
+    for col, dtype in cfg.tse_closing_prices_dtypes.items():
+        if col in prices and col != "PriceFirst":
+            assert res[col].dtype == dtype
+    assert res["Symbol"].dtype == prices["Symbol"].dtype
+    assert res["PriceMin"].tolist() == [13890, 3e9]
+    # missing values are kept in a nullable dtype
+    assert res["PriceFirst"].dtype == "Int64"
+    assert res["PriceFirst"].isna().tolist() == [False, True]
+    pd.testing.assert_frame_equal(res, prices, check_dtype=False)
+
+    for col, value in [("PriceMax", 13890.5), ("ZTotTran", -1), ("DEven", 3e9)]:
+        with pytest.raises(ValueError, match=col):
+            tse_utils.to_prices_dtypes(prices.assign(**{col: value}))